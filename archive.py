@@ -0,0 +1,160 @@
+from audio import floatToPcm, pcmToFloat, resampleAudio, saveWithFfmpeg
+import datetime
+import os
+import queue
+import threading
+import time
+import wave
+
+# file extension, ffmpeg codec and bitrate for each format. wav is written without ffmpeg.
+ARCHIVE_FORMATS = {
+    "wav": ("wav", None, None),
+    "flac": ("flac", "flac", None),
+    "opus": ("opus", "libopus", "24k"),
+}
+
+# keeps recordings of what was received and transmitted, and the transcript, in one directory.
+#
+# everything is handed to a background thread, so nothing here does file io (or encoding) on the caller's thread.
+# the transcript is kept open and flushed once a second rather than being reopened for every line.
+# once the transcript is over maxTranscriptBytes it's renamed with the date and a new one is started.
+# if maxAgeSeconds or maxBytes are set, the oldest recordings and old transcripts are deleted once they are
+# older than maxAgeSeconds, or once there are more than maxBytes of them. nothing else in the directory is touched.
+class Archive:
+    def __init__(self, directory, format = "wav", sampleRate = 16000, maxBytes = 0, maxAgeSeconds = 0, maxTranscriptBytes = 0, metrics = None):
+        if format not in ARCHIVE_FORMATS:
+            raise Exception(f"Unknown archive format {format}.")
+
+        self.directory = directory
+        self.format = format
+        # recordings are resampled to this before they're written, None to keep their own rate
+        self.sampleRate = sampleRate
+        # 0 means no limit
+        self.maxBytes = maxBytes
+        self.maxAgeSeconds = maxAgeSeconds
+        self.maxTranscriptBytes = maxTranscriptBytes
+        self.metrics = metrics
+
+        self.transcriptPath = os.path.join(directory, "transcript.log")
+        self.transcriptFile = None
+
+        self.queue = queue.Queue()
+
+        os.makedirs(self.directory, exist_ok = True)
+
+        threading.Thread(target = self._writeLoop, name = "archive", daemon = True).start()
+
+    # name has no extension, eg. "rx-2024-01-01_12-00-00". data is int16 pcm, as bytes or a numpy array.
+    # it's written later, so it mustn't be changed after it's handed over.
+    def saveAudio(self, name, data, sampleRate):
+        self.queue.put(("audio", name, data, sampleRate))
+
+    def appendTranscript(self, line):
+        self.queue.put(("transcript", line, None, None))
+
+    def _writeLoop(self):
+        lastPruneTime = 0
+        lastFlushTime = 0
+
+        while True:
+            try:
+                kind, name, data, sampleRate = self.queue.get(timeout = 1)
+
+                if kind == "audio":
+                    self._writeAudio(name, data, sampleRate)
+                else:
+                    self._writeTranscript(name)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"A {type(e).__name__} exception occurred while archiving:", e)
+
+            try:
+                if self.transcriptFile is not None and time.time() - lastFlushTime >= 1:
+                    lastFlushTime = time.time()
+                    self.transcriptFile.flush()
+
+                # listing the directory isn't free, so only prune once a minute
+                if time.time() - lastPruneTime >= 60:
+                    lastPruneTime = time.time()
+                    self.prune()
+            except Exception as e:
+                print(f"A {type(e).__name__} exception occurred while archiving:", e)
+
+    def _writeAudio(self, name, data, sampleRate):
+        startTime = time.time()
+
+        data = memoryview(data).cast("B")
+
+        extension, codec, bitrate = ARCHIVE_FORMATS[self.format]
+        path = os.path.join(self.directory, f"{name}.{extension}")
+        toRate = self.sampleRate or sampleRate
+
+        if codec is not None:
+            saveWithFfmpeg(path, data, sampleRate, toRate, codec, bitrate)
+        else:
+            if toRate != sampleRate:
+                data = floatToPcm(resampleAudio(pcmToFloat(data), sampleRate, toRate))
+
+            with wave.open(path, "wb") as wf:
+                wf.setnchannels(1)
+                wf.setsampwidth(2)
+                wf.setframerate(toRate)
+                wf.writeframes(data)
+
+        if self.metrics is not None:
+            self.metrics.observe("archiveWrite", time.time() - startTime)
+
+    def _writeTranscript(self, line):
+        if self.transcriptFile is None:
+            self.transcriptFile = open(self.transcriptPath, "a")
+
+        self.transcriptFile.write(f"{line}\n")
+
+        if self.maxTranscriptBytes > 0 and self.transcriptFile.tell() >= self.maxTranscriptBytes:
+            self.transcriptFile.close()
+            self.transcriptFile = None
+
+            os.rename(self.transcriptPath, os.path.join(self.directory, f"transcript-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"))
+
+    # whether a file in the directory is one the archive wrote and can delete.
+    # the current transcript is never deleted
+    @staticmethod
+    def isArchivedFile(name):
+        if name.startswith(("rx-", "tx-")):
+            return name.endswith(tuple(f".{extension}" for extension, codec, bitrate in ARCHIVE_FORMATS.values()))
+
+        return name.startswith("transcript-") and name.endswith(".log")
+
+    # deletes the oldest recordings and rotated transcripts until they're within maxAgeSeconds and maxBytes
+    def prune(self):
+        if self.maxBytes <= 0 and self.maxAgeSeconds <= 0:
+            return
+
+        files = []
+        # only what the archive could delete counts towards maxBytes
+        totalBytes = 0
+
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and self.isArchivedFile(entry.name):
+                stat = entry.stat()
+                totalBytes += stat.st_size
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+
+        now = time.time()
+        deleted = 0
+
+        # oldest first
+        for mtime, path, size in sorted(files):
+            tooOld = self.maxAgeSeconds > 0 and now - mtime > self.maxAgeSeconds
+            tooBig = self.maxBytes > 0 and totalBytes > self.maxBytes
+
+            if not tooOld and not tooBig:
+                break
+
+            os.remove(path)
+            totalBytes -= size
+            deleted += 1
+
+        if deleted > 0:
+            print(f"Deleted {deleted} old recordings from the archive.")
@@ -0,0 +1,204 @@
+import abc
+import importlib.util
+import time
+
+# whisper decodes audio in windows of this many seconds
+WHISPER_WINDOW_SECONDS = 30
+# every engine takes float32 mono audio at this rate
+ASR_SAMPLE_RATE = 16000
+# whisper can't generate more than this many tokens for one window
+WHISPER_MAX_TOKENS = 224
+
+# how an engine decodes audio. anything left as None is up to the engine.
+#
+# the general profile is whisper's own defaults: it detects the language, and decodes again at higher
+# temperatures whenever the result looks wrong. the radio profile is for short transmissions in one
+# language: the language is fixed, decoding is greedy and only done once, and the number of tokens that
+# can be generated is capped by how long the clip is, so a short clip can't run on for a whole window.
+class DecodingProfile:
+    def __init__(self, language = None, beamSize = None, temperatureFallback = True, tokensPerSecond = None, minTokens = 16):
+        self.language = language
+        self.beamSize = beamSize
+        self.temperatureFallback = temperatureFallback
+        # about 3 words a second, a few tokens each
+        self.tokensPerSecond = tokensPerSecond
+        self.minTokens = minTokens
+
+    # the most tokens it's worth generating for a clip of this many samples
+    def getMaxTokens(self, samples):
+        if self.tokensPerSecond is None:
+            return None
+
+        return min(WHISPER_MAX_TOKENS, self.minTokens + int(samples / ASR_SAMPLE_RATE * self.tokensPerSecond))
+
+def createDecodingProfile(name, language = "en", beamSize = 1):
+    if name == "radio":
+        return DecodingProfile(language, beamSize, temperatureFallback = False, tokensPerSecond = 8)
+
+    return DecodingProfile()
+
+# the interface every speech recognition backend has.
+# audio is a float32 numpy array of mono 16khz samples.
+class AsrEngine(abc.ABC):
+    name = None
+    # whether transcribeBatch decodes the clips together, rather than one at a time
+    supportsBatching = False
+
+    def __init__(self, modelName, profile = None):
+        self.modelName = modelName
+        self.profile = profile or DecodingProfile()
+
+    # returns (text, segments), where segments is a list of (start, end, text).
+    # prompt is text that might have come before the audio, which whisper uses to pick between similar sounding words.
+    # without timestamps each segment covers the whole window, which saves decoding the timestamp tokens.
+    @abc.abstractmethod
+    def transcribe(self, audio, prompt = None, timestamps = True):
+        pass
+
+    # returns the text of each clip. engines that can decode several clips at once override this.
+    def transcribeBatch(self, audios, prompt = None):
+        return [self.transcribe(audio, prompt, timestamps = False)[0] for audio in audios]
+
+    # transcribes audio a few times and reports how long it took compared to how long the audio is
+    def selfTest(self, audio, runs = 3):
+        # the first pass is always slower, so it isn't counted
+        text, segments = self.transcribe(audio, timestamps = False)
+
+        startTime = time.time()
+        for i in range(runs):
+            self.transcribe(audio, timestamps = False)
+        seconds = (time.time() - startTime) / runs
+
+        return {
+            "backend": self.name,
+            "model": self.modelName,
+            "seconds": seconds,
+            # below 1 is faster than realtime
+            "realtimeFactor": seconds / (len(audio) / ASR_SAMPLE_RATE),
+            "text": text.strip(),
+        }
+
+# openai's reference implementation, on pytorch
+class WhisperEngine(AsrEngine):
+    name = "whisper"
+    supportsBatching = True
+
+    def __init__(self, modelName = "base", device = "cpu", threads = 0, profile = None):
+        super().__init__(modelName, profile)
+
+        import torch
+        import whisper
+
+        # 0 leaves it up to pytorch, which uses every core
+        if threads > 0:
+            torch.set_num_threads(threads)
+
+        self.device = device
+        self.model = whisper.load_model(modelName, device = device)
+
+    # options for whisper's DecodingOptions
+    def _getDecodingOptions(self, samples, timestamps):
+        options = {
+            # fp16 is only supported on the gpu, on the cpu it generates a warning (at least on macos)
+            "fp16": self.device != "cpu",
+            "without_timestamps": not timestamps,
+        }
+
+        if self.profile.language is not None:
+            options["language"] = self.profile.language
+
+        # whisper is greedy unless it's given a beam size
+        if self.profile.beamSize is not None and self.profile.beamSize > 1:
+            options["beam_size"] = self.profile.beamSize
+
+        # the encoder always works on a whole 30 second window, but the decoder's time goes with how many tokens it generates
+        if self.profile.getMaxTokens(samples) is not None:
+            options["sample_len"] = self.profile.getMaxTokens(samples)
+
+        return options
+
+    def transcribe(self, audio, prompt = None, timestamps = True):
+        options = self._getDecodingOptions(len(audio), timestamps)
+
+        if not self.profile.temperatureFallback:
+            options["temperature"] = 0.0
+            options["condition_on_previous_text"] = False
+
+        result = self.model.transcribe(audio, initial_prompt = prompt, **options)
+
+        return result["text"], [(segment["start"], segment["end"], segment["text"]) for segment in result["segments"]]
+
+    # decodes a single window per clip, as one batch through the model, without transcribe's temperature fallback.
+    # every clip has to fit in whisper's 30 second window.
+    def transcribeBatch(self, audios, prompt = None):
+        import torch
+        import whisper
+
+        if any(len(audio) > ASR_SAMPLE_RATE * WHISPER_WINDOW_SECONDS for audio in audios):
+            return super().transcribeBatch(audios, prompt)
+
+        mels = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), self.model.dims.n_mels) for audio in audios]).to(self.model.device)
+        results = whisper.decode(self.model, mels, whisper.DecodingOptions(prompt = prompt, **self._getDecodingOptions(max(len(audio) for audio in audios), False)))
+
+        return [result.text for result in results]
+
+# ctranslate2 through faster-whisper, which can run whisper quantised to int8.
+# on the cpu this is several times faster than the reference implementation for about the same accuracy.
+class FasterWhisperEngine(AsrEngine):
+    name = "faster-whisper"
+
+    def __init__(self, modelName = "base", device = "cpu", threads = 0, computeType = "int8", profile = None):
+        super().__init__(modelName, profile)
+
+        from faster_whisper import WhisperModel
+
+        # cpu_threads of 0 leaves it up to ctranslate2
+        self.model = WhisperModel(modelName, device = device, compute_type = computeType, cpu_threads = threads)
+
+    def transcribe(self, audio, prompt = None, timestamps = True):
+        options = {
+            "without_timestamps": not timestamps,
+        }
+
+        if self.profile.language is not None:
+            options["language"] = self.profile.language
+
+        if self.profile.beamSize is not None:
+            options["beam_size"] = self.profile.beamSize
+
+        if not self.profile.temperatureFallback:
+            options["temperature"] = 0.0
+            options["condition_on_previous_text"] = False
+
+        if self.profile.getMaxTokens(len(audio)) is not None:
+            options["max_new_tokens"] = self.profile.getMaxTokens(len(audio))
+
+        # segments is a generator, decoding happens as it's read
+        segments = [(segment.start, segment.end, segment.text) for segment in self.model.transcribe(audio, initial_prompt = prompt, **options)[0]]
+
+        return "".join(text for start, end, text in segments), segments
+
+# backend -> the module it needs
+asrBackends = {
+    "whisper": "whisper",
+    "faster-whisper": "faster_whisper",
+}
+
+def isAsrBackendInstalled(backend):
+    return importlib.util.find_spec(asrBackends[backend]) is not None
+
+def getInstalledAsrBackends():
+    return [backend for backend in asrBackends if isAsrBackendInstalled(backend)]
+
+# backend "auto" uses faster-whisper if it's installed, and whisper if it isn't
+def createAsrEngine(backend, modelName, device = "cpu", threads = 0, computeType = "int8", profile = None):
+    if backend == "auto":
+        backend = "faster-whisper" if isAsrBackendInstalled("faster-whisper") else "whisper"
+
+    if not isAsrBackendInstalled(backend):
+        raise Exception(f"The {backend} asr backend isn't installed.")
+
+    if backend == "faster-whisper":
+        return FasterWhisperEngine(modelName, device, threads, computeType, profile)
+
+    return WhisperEngine(modelName, device, threads, profile)
@@ -0,0 +1,309 @@
+import collections
+import numpy
+import os
+import pyaudio
+import queue
+import subprocess
+import threading
+import time
+import wave
+
+# resamples float32 audio using a windowed sinc low pass (when downsampling) followed by linear interpolation
+def resampleAudio(samples, fromRate, toRate):
+    if fromRate == toRate:
+        return samples
+
+    if toRate < fromRate:
+        # cut off just below the new nyquist frequency to stop aliasing
+        cutoff = 0.45 * toRate / fromRate
+        taps = numpy.arange(-32, 33)
+        kernel = 2 * cutoff * numpy.sinc(2 * cutoff * taps) * numpy.hanning(len(taps))
+        kernel /= kernel.sum()
+        samples = numpy.convolve(samples, kernel.astype(numpy.float32), mode = "same")
+
+    duration = len(samples) / fromRate
+    newTimes = numpy.arange(0, int(duration * toRate)) / toRate
+    oldTimes = numpy.arange(0, len(samples)) / fromRate
+
+    return numpy.interp(newTimes, oldTimes, samples).astype(numpy.float32)
+
+def pcmToFloat(data):
+    return numpy.frombuffer(data, dtype = numpy.int16).astype(numpy.float32) / 32768.0
+
+def floatToPcm(samples):
+    return (numpy.clip(samples, -1.0, 1.0) * 32767).astype(numpy.int16).tobytes()
+
+# the ffmpeg command that decodes path into mono int16 pcm at the given rate, written to stdout
+def getFfmpegDecodeCommand(path, sampleRate):
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-i", path,
+        "-f", "s16le",
+        "-ac", "1",
+        "-ar", str(sampleRate),
+        "pipe:"
+    ]
+
+# decodes any file ffmpeg understands into mono float32 samples at the given rate
+def loadWithFfmpeg(path, sampleRate):
+    data = subprocess.run(getFfmpegDecodeCommand(path, sampleRate), stdout = subprocess.PIPE, check = True).stdout
+
+    return pcmToFloat(data)
+
+# like loadWithFfmpeg, but yields the int16 pcm a block at a time as ffmpeg decodes it
+def readBlocksWithFfmpeg(path, blockSeconds, sampleRate):
+    command = getFfmpegDecodeCommand(path, sampleRate)
+    blockBytes = max(1, int(blockSeconds * sampleRate)) * 2
+
+    with subprocess.Popen(command, stdout = subprocess.PIPE) as process:
+        try:
+            while True:
+                data = process.stdout.read(blockBytes)
+
+                if len(data) == 0:
+                    break
+
+                yield numpy.frombuffer(data, dtype = numpy.int16)
+        except GeneratorExit:
+            # whoever was reading has stopped, so there's no need to decode the rest
+            process.kill()
+            raise
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+# encodes mono int16 pcm to a file with ffmpeg, eg. codec "flac" or "libopus"
+def saveWithFfmpeg(path, data, fromRate, toRate, codec, bitrate = None):
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-y",
+            "-f", "s16le",
+            "-ac", "1",
+            "-ar", str(fromRate),
+            "-i", "pipe:",
+            "-ar", str(toRate),
+            "-c:a", codec,
+            *(["-b:a", bitrate] if bitrate is not None else []),
+            path
+        ],
+        input = data,
+        check = True
+    )
+
+# converts frames read from a wav into mono int16 pcm
+def wavFramesToPcm(data, sampleWidth, channels):
+    if sampleWidth == 1:
+        # 8 bit wav is unsigned
+        samples = (numpy.frombuffer(data, dtype = numpy.uint8).astype(numpy.int16) - 128) * 256
+    elif sampleWidth == 2:
+        samples = numpy.frombuffer(data, dtype = numpy.int16)
+    elif sampleWidth == 4:
+        samples = (numpy.frombuffer(data, dtype = numpy.int32) >> 16).astype(numpy.int16)
+    else:
+        raise Exception(f"Unsupported sample width {sampleWidth}")
+
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis = 1).astype(numpy.int16)
+
+    return samples
+
+# reads a wav file into mono float32 samples at the given rate
+def loadWav(path, sampleRate):
+    try:
+        wf = wave.open(path, "rb")
+    except wave.Error:
+        # the wave module only reads pcm, some wavs have compressed audio (eg. mp3) in them
+        return loadWithFfmpeg(path, sampleRate)
+
+    with wf:
+        channels = wf.getnchannels()
+        sampleWidth = wf.getsampwidth()
+        fileRate = wf.getframerate()
+        data = wf.readframes(wf.getnframes())
+
+    return resampleAudio(pcmToFloat(wavFramesToPcm(data, sampleWidth, channels)), fileRate, sampleRate)
+
+def readWavBlocks(wf, blockSeconds):
+    with wf:
+        channels = wf.getnchannels()
+        sampleWidth = wf.getsampwidth()
+        blockFrames = max(1, int(blockSeconds * wf.getframerate()))
+
+        while True:
+            data = wf.readframes(blockFrames)
+
+            if len(data) == 0:
+                break
+
+            yield wavFramesToPcm(data, sampleWidth, channels)
+
+# reads a recording a block of mono int16 pcm at a time, so that a long one never has to be in memory all at once.
+# returns (sampleRate, blocks). a pcm wav is read at its own rate, anything else is decoded by ffmpeg at sampleRate
+def readPcmBlocks(path, blockSeconds, sampleRate):
+    try:
+        wf = wave.open(path, "rb")
+    except wave.Error:
+        return sampleRate, readBlocksWithFfmpeg(path, blockSeconds, sampleRate)
+
+    return wf.getframerate(), readWavBlocks(wf, blockSeconds)
+
+# how many seconds long a recording is, from the wav header or ffprobe
+def getAudioDuration(path):
+    try:
+        with wave.open(path, "rb") as wf:
+            return wf.getnframes() / wf.getframerate()
+    except wave.Error:
+        pass
+
+    output = subprocess.run(
+        [
+            "ffprobe",
+            "-loglevel", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            path
+        ],
+        stdout = subprocess.PIPE,
+        check = True
+    ).stdout
+
+    return float(output)
+
+# plays everything through one long-lived output stream.
+# audio is queued and written by a single thread, so sounds queued
+# one after another play back to back without gaps.
+#
+# it's written a chunk at a time, so that the level of what's being played is known (for telling our own
+# audio apart from someone else's on the mic) and so that cancel can cut off whatever is playing.
+class AudioOutput:
+    def __init__(self, pyAudio, sampleRate = 44100, chunkSize = 1024, deviceIndex = None):
+        self.sampleRate = sampleRate
+        self.chunkSize = chunkSize
+        self.sounds = {}
+        self.noise = numpy.zeros(0, dtype = numpy.float32)
+
+        self.queue = queue.Queue()
+
+        # everything queued before the last cancel is thrown away instead of played
+        self.generation = 0
+
+        # (time, level) of the most recently written chunks
+        self.levels = collections.deque(maxlen = 256)
+        self.levelsLock = threading.Lock()
+
+        self.stream = pyAudio.open(
+            format = pyaudio.paInt16,
+            channels = 1,
+            rate = sampleRate,
+            output = True,
+            output_device_index = deviceIndex,
+            frames_per_buffer = chunkSize
+        )
+
+        threading.Thread(target = self._writeLoop, name = "audioOutput", daemon = True).start()
+
+    def _writeLoop(self):
+        chunkBytes = self.chunkSize * 2
+
+        while True:
+            generation, data = self.queue.get()
+
+            try:
+                # a marker from onPlayed
+                if callable(data):
+                    if generation == self.generation:
+                        data()
+                    continue
+
+                for start in range(0, len(data), chunkBytes):
+                    if generation != self.generation:
+                        break
+
+                    chunk = data[start:start + chunkBytes]
+                    samples = numpy.frombuffer(chunk, dtype = numpy.int16).astype(numpy.float32)
+
+                    with self.levelsLock:
+                        # same scale as VoiceActivityDetector's level
+                        self.levels.append((time.time(), float(numpy.sqrt(numpy.mean(samples * samples)))))
+
+                    self.stream.write(chunk)
+            finally:
+                self.queue.task_done()
+
+    # decodes every wav under directory, keyed by its path without the extension. eg "mdc/MDC1200"
+    def loadSounds(self, directory):
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                if file.startswith(".") or not file.endswith(".wav"):
+                    continue
+
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, directory)[:-4].replace(os.sep, "/")
+
+                self.sounds[name] = loadWav(path, self.sampleRate)
+
+        print(f"Loaded {len(self.sounds)} sounds.")
+
+    # uses sounds that another output has already decoded, rather than decoding them again
+    def shareSounds(self, other):
+        self.sounds = other.sounds
+
+    # white noise, like ffmpeg's anoisesrc=a=0.1:c=white
+    def generateNoise(self, lengthSeconds, amplitude = 0.1):
+        self.noise = numpy.random.default_rng().uniform(-amplitude, amplitude, int(lengthSeconds * self.sampleRate)).astype(numpy.float32)
+
+    def getSoundNames(self, directory):
+        return [name for name in self.sounds if name.startswith(f"{directory}/")]
+
+    def play(self, samples, volume = 1):
+        if volume != 1:
+            samples = samples * volume
+
+        self.queue.put((self.generation, floatToPcm(samples)))
+
+    # calls callback (on the writer thread) once everything queued before it has been played,
+    # unless it's cancelled first. used to tell which parts of a transmission were actually heard
+    def onPlayed(self, callback):
+        self.queue.put((self.generation, callback))
+
+    # stops what's playing and throws away everything that's queued. anything played after this is played as normal
+    def cancel(self):
+        self.generation += 1
+
+    # the loudest we've played in the last few seconds. the default covers the time
+    # between audio being written and it being heard back through the mic
+    def getLevel(self, seconds = 0.5):
+        since = time.time() - seconds
+
+        with self.levelsLock:
+            return max([level for levelTime, level in self.levels if levelTime >= since], default = 0)
+
+    def playSound(self, name, volume = 1):
+        if name not in self.sounds:
+            raise Exception(f"Sound {name} was not loaded.")
+
+        self.play(self.sounds[name], volume)
+
+    def playNoise(self, lengthSeconds, volume = 1):
+        length = int(lengthSeconds * self.sampleRate)
+
+        if length > len(self.noise):
+            self.generateNoise(lengthSeconds)
+
+        self.play(self.noise[:length], volume)
+
+    def playSilence(self, lengthSeconds):
+        self.play(numpy.zeros(int(lengthSeconds * self.sampleRate), dtype = numpy.float32))
+
+    # raw int16 pcm, eg. from piper
+    def playPcm(self, data, sampleRate, volume = 1):
+        self.play(resampleAudio(pcmToFloat(data), sampleRate, self.sampleRate), volume)
+
+    # blocks until everything queued so far has been played
+    def wait(self):
+        self.queue.join()
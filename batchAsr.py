@@ -0,0 +1,46 @@
+from asr import ASR_SAMPLE_RATE, createAsrEngine
+from audio import getAudioDuration, pcmToFloat, resampleAudio
+import datetime
+import multiprocessing
+import os
+import re
+
+# the asr engine of this worker process, loaded by initWorker when the process starts
+engine = None
+
+def initWorker(backend, modelName, device, threads, computeType, profile):
+    global engine
+    engine = createAsrEngine(backend, modelName, device, threads, computeType, profile)
+
+# runs in a worker. samples are the int16 pcm of one transmission.
+# returns (text, segments) like AsrEngine.transcribe
+def transcribeSegment(samples, sampleRate, prompt):
+    return engine.transcribe(resampleAudio(pcmToFloat(samples), sampleRate, ASR_SAMPLE_RATE), prompt)
+
+# a pool of processes that each have their own asr engine, so that recordings can be transcribed on every core at once.
+#
+# the workers are forked rather than spawned. main.py does everything when it's imported, so a spawned
+# worker would run all of it again. this means the pool has to be created before anything that doesn't
+# survive being forked, like pyaudio or the model loader threads, is set up.
+def createTranscriptionPool(processes, backend, modelName, device = "cpu", threads = 0, computeType = "int8", profile = None):
+    context = multiprocessing.get_context("fork")
+
+    return context.Pool(processes, initializer = initWorker, initargs = (backend, modelName, device, threads, computeType, profile))
+
+# the audio files to transcribe, in order. path can be a directory of recordings, or a single (eg. long) recording.
+# the archive's tx- recordings are our own transmissions, so they're left out.
+def getRecordingPaths(path):
+    if not os.path.isdir(path):
+        return [path]
+
+    return [os.path.join(path, f) for f in sorted(os.listdir(path)) if not f.startswith((".", "tx-")) and f.endswith((".wav", ".flac", ".opus"))]
+
+# when a recording started. the archive names received recordings after it (eg. rx-2024-01-01_12-00-00.wav),
+# anything else is assumed to have been written as soon as it finished.
+def getRecordingStartTime(path):
+    match = re.search(r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}", os.path.basename(path))
+
+    if match is not None:
+        return datetime.datetime.strptime(match.group(), "%Y-%m-%d_%H-%M-%S")
+
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path) - getAudioDuration(path))
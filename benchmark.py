@@ -0,0 +1,168 @@
+from audio import AudioOutput, loadWav
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import numpy
+import resource
+import sys
+import threading
+
+# a recording, as the int16 samples the microphone would have given us.
+# padSeconds of silence is added to the end so the vad sees the transmission finish.
+class FileInputSource:
+    def __init__(self, path, sampleRate, padSeconds = 0):
+        samples = loadWav(path, sampleRate)
+        self.length = len(samples)
+
+        samples = numpy.concatenate([samples, numpy.zeros(int(padSeconds * sampleRate), dtype = numpy.float32)])
+
+        self.samples = (numpy.clip(samples, -1.0, 1.0) * 32767).astype(numpy.int16)
+        self.sampleRate = sampleRate
+
+    # of the recording, not counting the padding
+    def getDuration(self):
+        return self.length / self.sampleRate
+
+# an AudioOutput that throws away everything instead of playing it
+class NullAudioOutput(AudioOutput):
+    def __init__(self, sampleRate = 44100):
+        self.sampleRate = sampleRate
+        self.sounds = {}
+        self.noise = numpy.zeros(0, dtype = numpy.float32)
+
+    def play(self, samples, volume = 1):
+        pass
+
+    def wait(self):
+        pass
+
+    def onPlayed(self, callback):
+        callback()
+
+    def cancel(self):
+        pass
+
+    def getLevel(self, seconds = 0.5):
+        return 0
+
+# a minimal local ollama that always gives the same response, so the rest of the pipeline can be measured without a model
+class StubOllamaServer:
+    def __init__(self, response = "Copy that, stand by. I'll check and get back to you."):
+        responseText = response
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson" if body.get("stream") else "application/json")
+                self.end_headers()
+
+                if body.get("stream"):
+                    for word in responseText.split(" "):
+                        self.wfile.write((json.dumps({ "message": { "role": "assistant", "content": word + " " }, "done": False }) + "\n").encode())
+
+                    self.wfile.write((json.dumps({ "done": True }) + "\n").encode())
+                else:
+                    self.wfile.write(json.dumps({ "message": { "role": "assistant", "content": responseText }, "done": True }).encode())
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.uri = f"http://127.0.0.1:{self.server.server_port}"
+
+        threading.Thread(target = self.server.serve_forever, name = "stubOllama", daemon = True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# finds transmissions in audio that's given to it a block at a time, the same way processLoop does:
+# a transmission starts on a chunk with speech and carries on while the vad is active.
+#
+# the vad keeps its state from one block to the next, and only the transmission that's still going
+# (and the pre-roll before it) is kept, so a long recording never has to be in memory all at once.
+class TransmissionSegmenter:
+    def __init__(self, vad, preRollChunks, maxChunks, minChunks = 0):
+        self.vad = vad
+        self.chunkSize = vad.chunkSize
+        self.maxChunks = maxChunks
+        # anything shorter is thrown away, like processLoop does
+        self.minChunks = minChunks
+
+        # the end of the last block, if it wasn't a whole chunk
+        self.remainder = numpy.zeros(0, dtype = numpy.int16)
+        # how many chunks have been evaluated
+        self.chunkCount = 0
+
+        # the chunks before the current transmission, which it would start with
+        self.preRoll = collections.deque(maxlen = preRollChunks)
+        # the chunk the current transmission started on, and its chunks (including the pre-roll)
+        self.start = None
+        self.chunks = []
+
+    # returns (startChunk, endChunk, samples) for each transmission that ended in this block (and was long enough).
+    # samples is the int16 pcm of the transmission, starting with the pre-roll
+    def write(self, samples):
+        samples = numpy.concatenate([self.remainder, samples])
+        count = len(samples) // self.chunkSize
+        self.remainder = samples[count * self.chunkSize:]
+
+        speech, active, levels = self.vad.evaluate(samples[:count * self.chunkSize])
+        transmissions = []
+
+        for i in range(count):
+            chunk = samples[i * self.chunkSize:(i + 1) * self.chunkSize]
+            index = self.chunkCount + i
+
+            if self.start is None:
+                if speech[i]:
+                    self.start = index
+                    self.chunks = list(self.preRoll)
+                    self.preRoll.clear()
+            elif not active[i] or index - self.start >= self.maxChunks:
+                transmissions += self._end(index)
+
+            if self.start is None:
+                self.preRoll.append(chunk)
+            else:
+                self.chunks.append(chunk)
+
+        self.chunkCount += count
+
+        return transmissions
+
+    # ends the transmission that's still going when the recording ends, if there is one
+    def finish(self):
+        return self._end(self.chunkCount) if self.start is not None else []
+
+    # returns the transmission that ended on chunk end, or nothing if it was too short
+    def _end(self, end):
+        transmissions = [(self.start, end, numpy.concatenate(self.chunks))] if end - self.start >= self.minChunks else []
+
+        self.start = None
+        self.chunks = []
+
+        return transmissions
+
+def summarizeLatencies(values):
+    if len(values) == 0:
+        return { "count": 0 }
+
+    return {
+        "count": len(values),
+        "p50": float(numpy.percentile(values, 50)),
+        "p95": float(numpy.percentile(values, 95)),
+        "max": float(numpy.max(values)),
+    }
+
+# peak resident set size of this process, in megabytes
+def getPeakRss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # linux reports kilobytes, macos reports bytes
+    if sys.platform == "darwin":
+        return peak / 1048576
+    else:
+        return peak / 1024
@@ -0,0 +1,131 @@
+import math
+import numpy
+
+# a transmission's int16 audio, in a buffer that was allocated before it started.
+# chunks are copied straight into place as they're captured, and readers get views of the buffer instead of copies.
+#
+# len(recording) is how many chunks have been written, and recording[i:j] is a view of the samples of chunks i to j,
+# so it can be used in place of a list of chunks. what has been written never changes, so it's safe to read
+# from another thread while more is being written.
+class Recording:
+    def __init__(self, buffer, chunkSize, length = 0):
+        self.buffer = buffer
+        self.chunkSize = chunkSize
+        # in samples
+        self.length = length
+
+    def __len__(self):
+        return self.length // self.chunkSize
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("Recordings can only be sliced.")
+
+        start, stop, step = index.indices(len(self))
+
+        return self.buffer[start * self.chunkSize:stop * self.chunkSize]
+
+    def getSamples(self):
+        return self.buffer[:self.length]
+
+    def isFull(self):
+        return self.length + self.chunkSize > len(self.buffer)
+
+    # copies samples into the end of the recording and returns a view of where they went
+    def write(self, samples):
+        end = self.length + len(samples)
+
+        if end > len(self.buffer):
+            raise Exception("The recording is full.")
+
+        view = self.buffer[self.length:end]
+        view[:] = samples
+        # only moved on once the samples are in place, so readers never see a chunk that's half written
+        self.length = end
+
+        return view
+
+# holds the audio coming from the mic for processLoop.
+#
+# until a transmission starts, chunks go into a ring holding the last preRollSeconds of audio, so that
+# the start of a transmission from before the vad triggered (usually the first syllable of the callsign)
+# isn't lost. when one starts, the ring is copied into a recording that was allocated ahead of time, big
+# enough for the ring and maxSeconds of audio, and every chunk after that is written straight into it.
+class CaptureBuffer:
+    def __init__(self, sampleRate, chunkSize, maxSeconds, preRollSeconds):
+        self.chunkSize = chunkSize
+
+        # the ring always holds at least the latest chunk, which is the one that starts a transmission
+        self.preRollChunks = max(1, math.ceil(preRollSeconds * sampleRate / chunkSize))
+        self.preRoll = numpy.zeros(self.preRollChunks * chunkSize, dtype = numpy.int16)
+        # the oldest chunk in the ring, and how many it has in it
+        self.preRollStart = 0
+        self.preRollCount = 0
+
+        # the pre-roll, the longest transmission, and the chunk that ends it
+        self.capacity = (self.preRollChunks + math.ceil(maxSeconds * sampleRate / chunkSize) + 1) * chunkSize
+        self.nextBuffer = numpy.empty(self.capacity, dtype = numpy.int16)
+
+        self.recording = None
+
+    # copies a chunk of int16 pcm from the mic into the buffer, and returns a view of it
+    def write(self, data):
+        samples = numpy.frombuffer(data, dtype = numpy.int16)
+
+        if self.recording is not None:
+            return self.recording.write(samples)
+
+        if self.preRollCount < self.preRollChunks:
+            index = (self.preRollStart + self.preRollCount) % self.preRollChunks
+            self.preRollCount += 1
+        else:
+            # overwrite the oldest chunk
+            index = self.preRollStart
+            self.preRollStart = (self.preRollStart + 1) % self.preRollChunks
+
+        view = self.preRoll[index * self.chunkSize:(index + 1) * self.chunkSize]
+        view[:] = samples
+
+        return view
+
+    # starts a recording with the pre-roll in it, which includes the chunk that was just written
+    def startRecording(self):
+        recording = Recording(self.nextBuffer, self.chunkSize)
+
+        # oldest first
+        for i in range(self.preRollCount):
+            index = (self.preRollStart + i) % self.preRollChunks
+            recording.write(self.preRoll[index * self.chunkSize:(index + 1) * self.chunkSize])
+
+        self.preRollStart = 0
+        self.preRollCount = 0
+        self.recording = recording
+
+        return recording
+
+    # starts the recording again from chunk start of it (and the pre-roll before that), throwing away everything earlier.
+    # the old recording's buffer is used for the next one
+    def restartRecording(self, start):
+        recording = Recording(self.nextBuffer, self.chunkSize)
+        recording.write(self.recording[max(0, start - (self.preRollChunks - 1)):len(self.recording)])
+
+        self.nextBuffer = self.recording.buffer
+        self.recording = recording
+
+        return recording
+
+    # hands the recording over to whoever is going to use it
+    def stopRecording(self):
+        recording = self.recording
+        self.recording = None
+
+        # the next recording's buffer is allocated now, rather than when it's needed
+        self.nextBuffer = numpy.empty(self.capacity, dtype = numpy.int16)
+
+        return recording
+
+    # throws the recording away, its buffer is used for the next one.
+    # a cancelled StreamingTranscriber might still be reading it, but what it reads is thrown away too.
+    def discardRecording(self):
+        self.nextBuffer = self.recording.buffer
+        self.recording = None
@@ -0,0 +1,94 @@
+import json
+import queue
+import threading
+import time
+
+# everything that belongs to one radio interface: its devices, prompt, voices and who it's talking to.
+# the whisper model, ollama and the speech cache are shared by every channel.
+class Channel:
+    def __init__(self, name, prompt, voiceName, idleVoiceName, inputDevice = None, outputDevice = None, maxQueuedChunks = 512):
+        self.name = name
+        # the parsed prompt file, { "primary": ..., "idle1": ..., "idle2": ... }
+        self.prompt = prompt
+        # names of voices in the voice pool. the idle voice can be "random"
+        self.voiceName = voiceName
+        self.idleVoiceName = idleVoiceName
+        # pyaudio device indexes, None for the default device
+        self.inputDevice = inputDevice
+        self.outputDevice = outputDevice
+
+        # set up by main.py once the channel is created
+        self.audioOutput = None
+        self.conversation = None
+
+        self.lastUnit = None
+
+        self.lastIdleMessageTime = 0
+        self.nextIdleMessageDelay = 0
+        self.lastIdleMessage = "Karnaka Station, this is research command, radio check."
+        # "dispatcher" or "idle"
+        self.lastIdleSpeaker = None
+
+        # the next idle message, generated and synthesised ahead of time so that it can be played as soon as it's due
+        self.idleSpeculation = None
+        self.idleSpeculationLock = threading.Lock()
+
+        # opened in callback mode, portaudio's thread puts chunks straight into chunkQueue
+        self.micStream = None
+        # how many chunks the stream should throw away before it starts queueing them
+        self.discardChunks = 0
+        # when we keyed up, for the playback metric
+        self.transmitStartTime = None
+
+        # (timestamp, data) for each chunk read from the mic
+        self.chunkQueue = queue.Queue(maxsize = maxQueuedChunks)
+        # ("rx", transcription, totalProcessStart), ("idle", None, None) or ("error", None, None)
+        self.replyQueue = queue.Queue()
+
+        # when processLoop last heard speech, for the idle timer. counts from startup until then
+        self.lastDetectionTime = time.time()
+
+        # set while processLoop is recording a transmission
+        self.receiving = threading.Event()
+        # set while we're keyed up
+        self.transmitting = threading.Event()
+        # set when a unit keys up while we're transmitting, to cut our transmission short
+        self.bargeIn = threading.Event()
+        # set while the reply worker is handling something
+        self.replying = threading.Event()
+        # set while an idle message is waiting for or being handled by the reply worker
+        self.idlePending = threading.Event()
+
+    def __repr__(self):
+        return f"Channel({self.name})"
+
+# reads a list of channels from a json file, eg.
+# [
+#     { "name": "police", "inputDevice": 2, "outputDevice": 3, "prompt": "PoliceDispatch", "piperVoice": "en_US-libritts_r-medium" },
+#     { "name": "fire", "inputDevice": 4, "outputDevice": 5, "prompt": "RacoonCityDispatch", "idleVoice": "en_GB-alba-medium" }
+# ]
+# anything left out of a channel is taken from defaults.
+def loadChannelConfigs(path, defaults):
+    with open(path, "r") as channelsFile:
+        configs = json.load(channelsFile)
+
+    if not isinstance(configs, list) or len(configs) == 0:
+        raise Exception(f"{path} should contain a list of channels.")
+
+    names = set()
+    channels = []
+
+    for i, config in enumerate(configs):
+        config = { **defaults, "name": f"channel{i + 1}", **config }
+
+        unknown = set(config) - set(defaults) - { "name" }
+        if len(unknown) > 0:
+            raise Exception(f"Unknown setting(s) for channel {config['name']}: {', '.join(sorted(unknown))}")
+
+        if config["name"] in names:
+            raise Exception(f"There is more than one channel called {config['name']}.")
+
+        names.add(config["name"])
+        channels.append(config)
+
+    return channels
@@ -0,0 +1,131 @@
+import threading
+
+# a rough token count, good enough for budgeting. most tokenizers average about 4 characters per token in english.
+def estimateTokens(text):
+    return len(text) // 4 + 4
+
+# keeps the message history sent to the llm within a token budget, so prompt time doesn't grow with the length of the session.
+#
+# each unit gets its own thread of messages. the system prompt is always sent first. when a thread goes over
+# the budget, its oldest messages are folded into a short summary in the background (if summarize is given)
+# and the summary is sent in their place. until the summary is ready the old messages are still sent as they are.
+#
+# summarize(previousSummary, messages) returns the new summary text.
+class ConversationMemory:
+    def __init__(self, systemPrompt, tokenBudget, summarize = None, keepMessages = 2):
+        self.systemPrompt = systemPrompt
+        self.tokenBudget = tokenBudget
+        self.summarize = summarize
+        # the most recent messages are never folded
+        self.keepMessages = keepMessages
+
+        # unit -> { "messages": [...], "folding": [...], "summary": str or None, "summarizing": bool }
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def _getThread(self, unit):
+        if unit not in self.threads:
+            self.threads[unit] = {
+                "messages": [],
+                "folding": [],
+                "summary": None,
+                "summarizing": False,
+            }
+
+        return self.threads[unit]
+
+    @staticmethod
+    def _countTokens(messages):
+        return sum(estimateTokens(message["content"]) for message in messages)
+
+    def addMessage(self, unit, role, content):
+        with self.lock:
+            thread = self._getThread(unit)
+            thread["messages"].append({
+                "role": role,
+                "content": content
+            })
+
+            self._trim(unit, thread)
+
+    def _trim(self, unit, thread):
+        messages = thread["messages"]
+
+        if self._countTokens(messages) <= self.tokenBudget:
+            return
+
+        # fold down to 3/4 of the budget, so that we're not summarising after every message
+        fold = []
+        while len(messages) > self.keepMessages and self._countTokens(messages) > self.tokenBudget * 0.75:
+            fold.append(messages.pop(0))
+
+        if len(fold) == 0:
+            return
+
+        if self.summarize is None:
+            print(f"Dropped {len(fold)} old messages from the conversation with {unit or 'nobody'}.")
+            return
+
+        thread["folding"].extend(fold)
+
+        # only one summary per thread at a time, anything folded meanwhile is picked up once it's done
+        if not thread["summarizing"]:
+            thread["summarizing"] = True
+            threading.Thread(target = self._summarizeThread, args = (unit, thread), name = "summarize", daemon = True).start()
+
+    def _summarizeThread(self, unit, thread):
+        while True:
+            with self.lock:
+                folding = list(thread["folding"])
+                summary = thread["summary"]
+
+                if len(folding) == 0:
+                    thread["summarizing"] = False
+                    return
+
+            try:
+                summary = self.summarize(summary, folding)
+            except Exception as e:
+                print(f"A {type(e).__name__} exception occurred while summarising the conversation:", e)
+                summary = None
+
+            with self.lock:
+                # the thread might have been reset while we were summarising
+                if self.threads.get(unit) is not thread:
+                    return
+
+                if summary is not None:
+                    thread["summary"] = summary
+
+                del thread["folding"][:len(folding)]
+
+            print(f"Folded {len(folding)} old messages from the conversation with {unit or 'nobody'} into the summary.")
+
+    # the messages to send to the llm for this unit
+    def getMessages(self, unit):
+        with self.lock:
+            thread = self._getThread(unit)
+
+            messages = [
+                {
+                    "role": "system",
+                    "content": self.systemPrompt
+                }
+            ]
+
+            if thread["summary"] is not None:
+                messages.append({
+                    "role": "system",
+                    "content": "Summary of the conversation so far: " + thread["summary"]
+                })
+
+            return messages + thread["folding"] + thread["messages"]
+
+    def resetAll(self):
+        with self.lock:
+            self.threads = {}
+
+    def getStatus(self, unit):
+        with self.lock:
+            thread = self._getThread(unit)
+            return f"Conversation with {unit or 'nobody'}: {len(thread['messages'])} messages (~{self._countTokens(thread['messages'])} tokens), {len(thread['folding'])} being summarised, {'a' if thread['summary'] is not None else 'no'} summary."
@@ -0,0 +1,145 @@
+import re
+
+# normalises a transcription so that small differences in whisper's output don't matter.
+# "I'm 10-8." -> "i'm 10 8"
+def normalizeText(text):
+    text = text.lower()
+    # keep apostrophes so "we're" stays one word
+    text = re.sub(r"[^a-z0-9' ]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+# edit distance between a and b, gives up and returns maxDistance + 1 once it's clear it will be over maxDistance
+def boundedEditDistance(a, b, maxDistance):
+    if abs(len(a) - len(b)) > maxDistance:
+        return maxDistance + 1
+
+    previous = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        rowMin = current[0]
+
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            rowMin = min(rowMin, current[j])
+
+        if rowMin > maxDistance:
+            return maxDistance + 1
+
+        previous = current
+
+    return previous[len(b)]
+
+# matches transcriptions to intents. built once from a table like:
+# {
+#     "available": { "prefixes": ["i'm", "we're"], "phrases": ["10-8", "in service"], "aliases": ["tonight"] },
+#     "callsign": { "suffix": "control", "slot": "unit" },
+# }
+# phrases are matched exactly (after normalising) with a hash lookup, then with a bounded fuzzy match.
+# aliases are matched the same way, they're how whisper mishears the phrases, so they aren't in getIntentVocabulary.
+# suffix intents capture whatever comes before the suffix into the slot.
+class IntentRouter:
+    def __init__(self, table, maxDistance = 2, maxDistanceRatio = 0.2):
+        self.maxDistance = maxDistance
+        self.maxDistanceRatio = maxDistanceRatio
+
+        # normalised phrase -> intent
+        self.phrases = {}
+        # word -> phrases containing that word, used to narrow down fuzzy matching
+        self.tokenIndex = {}
+        # (normalised suffix, intent, slot)
+        self.suffixes = []
+
+        for intent, entry in table.items():
+            if "suffix" in entry:
+                self.suffixes.append((normalizeText(entry["suffix"]), intent, entry.get("slot", "value")))
+                continue
+
+            prefixes = entry.get("prefixes", [""])
+
+            for prefix in prefixes:
+                for phrase in entry["phrases"] + entry.get("aliases", []):
+                    self.addPhrase(f"{prefix} {phrase}", intent)
+
+        # longest first so "over and out" wins over "out"
+        self.suffixes.sort(key = lambda suffix: len(suffix[0]), reverse = True)
+
+        print(f"Built intent router with {len(self.phrases)} phrases and {len(self.suffixes)} suffixes.")
+
+    def addPhrase(self, phrase, intent):
+        phrase = normalizeText(phrase)
+
+        if phrase in self.phrases and self.phrases[phrase] != intent:
+            raise Exception(f"Phrase \"{phrase}\" is used by both {self.phrases[phrase]} and {intent}.")
+
+        self.phrases[phrase] = intent
+
+        for token in phrase.split(" "):
+            self.tokenIndex.setdefault(token, set()).add(phrase)
+
+    def matchFuzzy(self, text):
+        candidates = set()
+
+        for token in text.split(" "):
+            candidates.update(self.tokenIndex.get(token, ()))
+
+        maxDistance = min(self.maxDistance, int(len(text) * self.maxDistanceRatio))
+
+        if maxDistance < 1:
+            return None
+
+        bestIntents = set()
+        bestDistance = maxDistance + 1
+
+        for phrase in candidates:
+            distance = boundedEditDistance(text, phrase, min(maxDistance, bestDistance))
+
+            if distance < bestDistance:
+                bestIntents = { self.phrases[phrase] }
+                bestDistance = distance
+            elif distance == bestDistance and distance <= maxDistance:
+                bestIntents.add(self.phrases[phrase])
+
+        # "i'm 10" is as close to "i'm 108" as it is to "i'm 107", better to ask again than guess
+        if len(bestIntents) != 1:
+            return None
+
+        return bestIntents.pop()
+
+    # returns (intent, slots), or (None, {}) if nothing matched
+    def match(self, text):
+        text = normalizeText(text)
+
+        if len(text) == 0:
+            return None, {}
+
+        intent = self.phrases.get(text)
+        if intent is not None:
+            return intent, {}
+
+        for suffix, intent, slot in self.suffixes:
+            if text == suffix or text.endswith(f" {suffix}"):
+                return intent, { slot: text[:-len(suffix)].strip() }
+
+        intent = self.matchFuzzy(text)
+        if intent is not None:
+            return intent, {}
+
+        return None, {}
+
+# the phrases and suffixes in an intent table, spelled the way the table spells them (eg. "10-8").
+# entries with "vocabulary": False (eg. passphrases) are left out
+def getIntentVocabulary(table):
+    vocabulary = []
+
+    for entry in table.values():
+        if not entry.get("vocabulary", True):
+            continue
+
+        if "suffix" in entry:
+            vocabulary.append(entry["suffix"])
+        else:
+            vocabulary += entry["phrases"]
+
+    return list(dict.fromkeys(vocabulary))
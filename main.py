@@ -1,3 +1,8 @@
+import time
+
+# everything in the startup report is measured from here
+startupStartTime = time.time()
+
 import argparse
 
 parser = argparse.ArgumentParser(
@@ -38,11 +43,51 @@ parser.add_argument("-dontSaveTranscript",
 )
 
 parser.add_argument("-saveReceivedAudio",
-    action = "store_false",
-    default = True,
+    action = "store_true",
+    default = False,
     help = "save files containing received transmission audio"
 )
 
+parser.add_argument("-saveTransmittedAudio",
+    action = "store_true",
+    default = False,
+    help = "save files containing the speech we transmitted"
+)
+
+parser.add_argument("-archiveFormat",
+    choices = [
+        "wav",
+        "flac",
+        "opus"
+    ],
+    default = "wav",
+    help = "format saved audio is written in. flac and opus are encoded with ffmpeg."
+)
+
+parser.add_argument("-archiveSampleRate",
+    type = int,
+    default = 16000,
+    help = "sample rate saved audio is written at. 0 keeps the rate it was captured or synthesised at. opus only supports 8000, 12000, 16000, 24000 and 48000."
+)
+
+parser.add_argument("-archiveMaxSize",
+    type = float,
+    default = 0,
+    help = "delete the oldest recordings and old transcripts once there are more than this many megabytes of them. 0 (the default) keeps everything."
+)
+
+parser.add_argument("-archiveMaxAge",
+    type = float,
+    default = 0,
+    help = "delete recordings and old transcripts that are older than this, in days. 0 (the default) keeps everything."
+)
+
+parser.add_argument("-transcriptMaxSize",
+    type = float,
+    default = 10,
+    help = "start a new transcript once it's bigger than this, in megabytes. the old one is kept with the date in its name. 0 disables this."
+)
+
 parser.add_argument("-delayNoise",
     type = float,
     default = 0.4,
@@ -72,6 +117,12 @@ parser.add_argument("-padDuration",
     help = "how long in seconds to keep listening before a received transmission is considered to be over"
 )
 
+parser.add_argument("-preRoll",
+    type = float,
+    default = 0.5,
+    help = "how much audio from before a transmission is detected to keep at the start of it, in seconds. stops the first syllable being cut off."
+)
+
 parser.add_argument("-maxDuration",
     type = float,
     default = 30,
@@ -81,7 +132,25 @@ parser.add_argument("-maxDuration",
 parser.add_argument("-threshold",
     type = int,
     default = 500,
-    help = "start recording once audio levels are above this value. when audio levels are below, the recording will be considered to be over."
+    help = "minimum audio level to start recording at. the actual threshold adapts to the background noise, but never goes below this."
+)
+
+parser.add_argument("-vadSnr",
+    type = float,
+    default = 3,
+    help = "how many times louder than the background noise audio has to be to start recording"
+)
+
+parser.add_argument("-vadMaxFlatness",
+    type = float,
+    default = 0.45,
+    help = "audio with a spectral flatness above this (0 to 1) is considered noise rather than speech, eg. squelch tails"
+)
+
+parser.add_argument("-vadMaxZeroCrossingRate",
+    type = float,
+    default = 0.4,
+    help = "audio that crosses zero more often than this (per sample) is considered noise rather than speech"
 )
 
 parser.add_argument("-voiceVolume",
@@ -108,6 +177,24 @@ parser.add_argument("-piperVoice",
     help = "which voice model piper should use"
 )
 
+parser.add_argument("-idleVoice",
+    type = str,
+    default = "en_GB-alba-medium",
+    help = "which voice model piper should use for whoever the dispatcher is talking to in idle chatter. random picks a different voice for each idle message."
+)
+
+parser.add_argument("-voicePoolMemory",
+    type = float,
+    default = 512,
+    help = "how much memory loaded voices can use, in megabytes. the least recently used voice is unloaded when this is exceeded."
+)
+
+parser.add_argument("-ttsThreads",
+    type = int,
+    default = 0,
+    help = "how many threads each voice can use for synthesis. 0 splits the cores between -ttsSlots."
+)
+
 parser.add_argument("-ollamaModel",
     type = str,
     default = "gemma2:2b",
@@ -120,6 +207,36 @@ parser.add_argument("-ollamaUri",
     help = "uri to ollama server. do not include trailing slash."
 )
 
+parser.add_argument("-ollamaKeepAlive",
+    type = str,
+    default = "30m",
+    help = "how long ollama should keep the model loaded after a request, eg. 30m or 24h. a number is in seconds, and a negative number keeps it loaded forever."
+)
+
+parser.add_argument("-ollamaTimeout",
+    type = float,
+    default = 120,
+    help = "how long to wait for a response from ollama, in seconds"
+)
+
+parser.add_argument("-ollamaConnectTimeout",
+    type = float,
+    default = 5,
+    help = "how long to wait to connect to ollama, in seconds"
+)
+
+parser.add_argument("-ollamaRetries",
+    type = int,
+    default = 2,
+    help = "how many times to retry a request to ollama that failed to connect or timed out"
+)
+
+parser.add_argument("-dontWarmUpOllama",
+    action = "store_true",
+    default = False,
+    help = "don't load the model in ollama at startup. the first response will take longer."
+)
+
 parser.add_argument("-prompt",
     type = str,
     default = "ResearchStation",
@@ -144,510 +261,2108 @@ parser.add_argument("-idleIntervalMax",
     help = "max time before next idle message"
 )
 
+parser.add_argument("-dontSpeculateIdle",
+    action = "store_true",
+    default = False,
+    help = "don't generate and synthesise the next idle message in the background while waiting for it to be due"
+)
+
 parser.add_argument("-initialStreamChunkDiscardCount",
     type = int,
     default = 2,
     help = "number of chunks to discard from the microphone stream after it has been initialised. helps to prevent recording from being triggered immediately after the stream is opened."
 )
 
-parser.add_argument("-debug",
+parser.add_argument("-streamResponse",
     action = "store_true",
-    help = "print more debug information"
+    default = False,
+    help = "stream the llm response and begin speaking it one sentence at a time while the rest is still being generated"
 )
 
-flags = parser.parse_args()
-
-print(flags.__dict__)
-
-import audioop
-import datetime
-import json
-import os
-from piper.voice import PiperVoice
-import pyaudio
-import requests
-import random
-import subprocess
-import sys
-import time
-import wave
-import whisper
+parser.add_argument("-bargeIn",
+    action = "store_true",
+    default = False,
+    help = "when a unit keys up while we are transmitting, stop talking (with the mdc end tone) and transcribe what they said straight away"
+)
 
-workingDirectory = os.path.join(os.path.expanduser("~"), "Documents/GitHub/dispatcher")
-recordingDirectory = os.path.join(workingDirectory, "recordings")
-soundsDirectory = os.path.join(workingDirectory, "sounds")
-voicesDirectory = os.path.join(workingDirectory, "voices")
-promptsDirectory = os.path.join(workingDirectory, "prompts")
+parser.add_argument("-bargeInEchoRatio",
+    type = float,
+    default = 1.0,
+    help = "how loud the mic has to be, compared to what we are playing, for it to be a unit breaking in rather than our own audio being heard back"
+)
 
-# only so that whisper can download different models
-import ssl
-ssl._create_default_https_context = ssl._create_unverified_context
+parser.add_argument("-bargeInMinDuration",
+    type = float,
+    default = 0.3,
+    help = "how many seconds of speech louder than our own audio it takes to stop transmitting"
+)
 
-whisperModel = whisper.load_model("base")
+parser.add_argument("-transmitOverlapPolicy",
+    choices = [
+        "drop",
+        "queue"
+    ],
+    default = "drop",
+    help = "what to do with transmissions that are received while we are transmitting. drop discards them (they are usually our own audio), queue replies to them after we finish."
+)
 
-p = pyaudio.PyAudio()
-MIC_STREAM_CHUNK_SIZE = 1024
+parser.add_argument("-maxQueuedTransmissions",
+    type = int,
+    default = 4,
+    help = "max number of received transmissions waiting to be transcribed, per channel. the oldest is dropped when this is exceeded."
+)
 
-def loadRandomPiperVoice():
-    return loadPiperVoice(random.choice([f for f in os.listdir(f"{voicesDirectory}/") if not f.startswith(".") and not f.endswith(".json")]))
+parser.add_argument("-maxQueuedChunks",
+    type = int,
+    default = 512,
+    help = "max number of microphone chunks waiting to be processed. the oldest is dropped when this is exceeded."
+)
 
-def loadPiperVoice(voice):
-    print(f"Loading voice: {voice}")
+parser.add_argument("-chunkSize",
+    type = int,
+    default = 1024,
+    help = "number of samples in each chunk read from the microphone. smaller chunks notice the end of a transmission sooner but cost more per second of audio. the benchmark reports the chunk size, so sizes can be compared"
+)
 
-    voice = PiperVoice.load(f"{voicesDirectory}/{voice}")
+parser.add_argument("-captureRate",
+    type = int,
+    choices = [
+        44100,
+        16000
+    ],
+    default = 44100,
+    help = "sample rate the microphone is captured at. 16000 is what whisper uses, so capturing at it skips resampling."
+)
 
-    # in piper, 0.8 is faster and 1.3 is slower.
-    # this formula reverses the number so that
-    # speed is consistent between gtts and piper
-    # 1.3 -> 0.8 and 0.8 -> 1.3 etc
-    voice.config.length_scale = 1 - (flags.voiceSpeed - 1.0)
+parser.add_argument("-speechCacheMemory",
+    type = float,
+    default = 32,
+    help = "how much synthesised speech to keep in memory, in megabytes"
+)
 
-    return voice
+parser.add_argument("-speechCacheSize",
+    type = float,
+    default = 256,
+    help = "how much synthesised speech to keep on disk, in megabytes. 0 disables the disk cache"
+)
 
-if flags.piperVoice == "random":
-    dispatcherVoice = loadRandomPiperVoice()
-else:
-    dispatcherVoice = loadPiperVoice(f"{flags.piperVoice}.onnx")
+parser.add_argument("-responseCacheSize",
+    type = int,
+    default = 256,
+    help = "how many of the llm's responses to keep, so that repeated traffic (eg. radio checks) is answered without asking the llm again. 0 disables the response cache"
+)
 
-voice2 = loadPiperVoice(f"en_GB-alba-medium.onnx")
+parser.add_argument("-responseCacheTtl",
+    type = int,
+    default = 3600,
+    help = "how many seconds a cached response is used for before the llm is asked again. 0 keeps them until they're evicted"
+)
 
-with open(f"{promptsDirectory}/{flags.prompt}.txt", "r") as promptFile:
-    prompt = promptFile.read()
-    prompt = json.loads(prompt)
+parser.add_argument("-responseCacheVariants",
+    type = int,
+    default = 1,
+    help = "how many different responses to collect from the llm for the same traffic before the cache answers it, picking one of them at random each time"
+)
 
-userMessageHistory = [
-    {
-        "role": "system",
-        "content": prompt["primary"]
-    }
-]
-
-lastIdleMessageTime = 0
-nextIdleMessageDelay = flags.idleIntervalMin
-lastIdleMessage = "Karnaka Station, this is research command, radio check."
-lastIdleSpeaker = None
-
-micStream = None
-
-lastUnit = None
-
-availablePhrases = [
-    "i'm 10-8",
-    "i'm 10.8",
-    "i'm 108",
-    "i'm ten eight"
-    "i'm available",
-    "i'm tonight",
-    "i'm available",
-    "i'm in service",
-
-    "show me 10-8",
-    "show me 10.8",
-    "show me 108",
-    "show me ten eight"
-    "show me available",
-    "show me tonight",
-    "show me available",
-    "show me in service",
-
-    "show us 10-8",
-    "show us 10.8",
-    "show us 108",
-    "show us ten eight",
-    "show us available",
-    "show us tonight",
-    "show us available",
-    "show us in service",
-
-    "we're 10-8",
-    "we're 10.8",
-    "we're 108",
-    "we're ten eight",
-    "we're available",
-    "we're tonight",
-    "we're available",
-    "we're in service",
-]
-
-unavailablePhrases = [
-    "i'm 10-7",
-    "i'm 10.7",
-    "i'm 107",
-    "i'm ten seven",
-    "i'm unavailable",
-    "i'm out of service",
-    "i'm ten seven",
-
-    "show me 10-7",
-    "show me 10.7",
-    "show me 107",
-    "show me ten seven",
-    "show me unavailable",
-    "show me out of service",
-    "show me ten seven",
-
-    "show us 10-7",
-    "show us 10.7",
-    "show us 107",
-    "show us ten seven",
-    "show us unavailable",
-    "show us out of service",
-    "show us ten seven",
-
-    "we're 10-7",
-    "we're 10.7",
-    "we're 107",
-    "we're ten seven",
-    "we're unavailable",
-    "we're out of service",
-    "we're ten seven",
-]
-
-def beginTransmit():
-    # if delayNoise is 0, the program will hang.
-    if flags.delayNoise is not None and flags.delayNoise > 0:
-        playNoise(lengthSeconds = flags.delayNoise)
-    elif flags.delay is not None:
-        time.sleep(flags.delay)
-    
-    if flags.mdcStart is not None:
-        if flags.mdcStart == "random":
-            playRandomSoundInDirectory("mdc")
-        else:
-            playSound(f"mdc/{flags.mdcStart}")
+parser.add_argument("-prewarmSpeechCache",
+    action = "store_true",
+    default = False,
+    help = "synthesise fixed responses at startup so they can be played immediately"
+)
 
-def endTransmit():
-    if flags.mdcEnd is not None:
-        if flags.mdcEnd == "random":
-            playRandomSoundInDirectory("mdc")
-        else:
-            playSound(f"mdc/{flags.mdcEnd}")
+parser.add_argument("-intentMaxDistance",
+    type = int,
+    default = 2,
+    help = "how many characters a transcription can differ from a known phrase by and still match it. 0 only allows exact matches"
+)
 
-def promptResponse(messageHistory):
-    startTime = time.time()
+parser.add_argument("-streamingTranscription",
+    action = "store_true",
+    default = False,
+    help = "transcribe transmissions while they are still being received, so only the last few seconds have to be transcribed once they end"
+)
 
-    print("Prompting response...")
+parser.add_argument("-streamingStep",
+    type = float,
+    default = 1,
+    help = "how often to update the partial transcription while receiving, in seconds"
+)
 
-    request = requests.post(f"{flags.ollamaUri}/api/chat", json = {
-        "model": flags.ollamaModel,
-        "messages": messageHistory,
-        "stream": False,
-    })
+parser.add_argument("-streamingWindow",
+    type = float,
+    default = 10,
+    help = "longest stretch of audio, in seconds, that is transcribed again on each update before it is committed"
+)
 
-    if flags.debug:
-        print("Raw response content: ", request.content)
+parser.add_argument("-earlyEndPadDuration",
+    type = float,
+    default = 0.5,
+    help = "with -streamingTranscription, how long in seconds to wait after speech stops before ending a transmission whose partial transcription already matches something we can respond to"
+)
 
-    print(f"Reponse took {round(time.time() - startTime, 2)}s to generate.")
+parser.add_argument("-contextTokens",
+    type = int,
+    default = 2048,
+    help = "roughly how many tokens of message history to send to the llm. older messages are summarised or dropped."
+)
 
-    response = request.json()
+parser.add_argument("-dontSummarizeHistory",
+    action = "store_true",
+    default = False,
+    help = "drop old messages once the message history is over -contextTokens instead of summarising them"
+)
 
-    if response.get("error") is not None:
-        raise Exception("Error response from model: " + response.get("error"))
-    elif response.get("message") is None:
-        raise Exception("Message from model was None.")
+parser.add_argument("-startupReport",
+    type = str,
+    help = "write how long each part of startup took to this json file"
+)
 
-    response = response.get("message")["content"].strip()
+parser.add_argument("-benchmark",
+    type = str,
+    help = "instead of listening, replay the rx-* recordings in this directory through the pipeline and report how long each stage took. the speech cache is not used."
+)
 
-    print(f"Response: {response}")
-    return response
+parser.add_argument("-benchmarkReport",
+    type = str,
+    help = "write the benchmark report to this json file instead of printing it"
+)
 
-def resetMessageHistory():
-    userMessageHistory[1:]
-    print("Message history reset.")
+parser.add_argument("-benchmarkUseOllama",
+    action = "store_true",
+    default = False,
+    help = "use the real ollama server while benchmarking, instead of a local stub that always gives the same response"
+)
 
-def speakResponse(text, voice):
-    global recordingDirectory
+parser.add_argument("-transcribeFiles",
+    type = str,
+    help = "instead of listening, find the transmissions in a directory of recordings (or in one long recording), transcribe them on every core, write them to -transcribeOutput and exit"
+)
 
-    startTime = time.time()
+parser.add_argument("-transcribeOutput",
+    type = str,
+    help = "json lines file to write the transcriptions from -transcribeFiles to. defaults to transcript.jsonl next to the recordings"
+)
 
-    print("Generating response audio...")
+parser.add_argument("-transcribeProcesses",
+    type = int,
+    default = 0,
+    help = "number of processes transcribing -transcribeFiles, each with its own copy of the asr model. 0 uses one per core"
+)
 
-    text = text.replace("*", "")
+parser.add_argument("-transcribeReplies",
+    action = "store_true",
+    default = False,
+    help = "also generate what we would have replied to each transmission in -transcribeFiles (using ollama), without speaking it"
+)
 
-    print("Generating speech...")
+parser.add_argument("-metricsFile",
+    type = str,
+    help = "append timings for each stage, and counters, to this json lines file"
+)
 
-    program = subprocess.Popen(
-        [
-            "ffplay",
-            "-hide_banner",
-            "-loglevel", "error",
-            "-f", "s16le",
-            "-ar", str(voice.config.sample_rate),
-            "-nodisp",
-            "-infbuf",
-            "-autoexit",
-            "-af", f"volume={flags.voiceVolume}",
-            # can't use atempo because it exits too early and cuts off the last phonem.
-            # instead, we use piper's length_scale to change voice speed.
-            "-i", "pipe:"
-        ],
-        stdout=sys.stdout,
-        stderr=subprocess.STDOUT,
-        stdin=subprocess.PIPE
-    )
+parser.add_argument("-prometheusFile",
+    type = str,
+    help = "write metrics to this file in prometheus text format, eg. for node_exporter's textfile collector"
+)
 
-    beginTransmit()
+parser.add_argument("-metricsInterval",
+    type = float,
+    default = 15,
+    help = "how often to rewrite -prometheusFile, in seconds"
+)
 
-    for byteData in voice.synthesize_stream_raw(text):
-        program.stdin.write(byteData)
+parser.add_argument("-levelMeterInterval",
+    type = float,
+    default = 0.1,
+    help = "how often to redraw the audio level meter, in seconds"
+)
 
-    program.stdin.close()
-    program.wait()
+parser.add_argument("-asrBackend",
+    choices = [
+        "auto",
+        "whisper",
+        "faster-whisper"
+    ],
+    default = "auto",
+    help = "speech recognition engine. faster-whisper runs whisper quantised with ctranslate2, and is much faster on the cpu. auto uses faster-whisper if it's installed."
+)
 
-    endTransmit()
+parser.add_argument("-asrModel",
+    type = str,
+    default = "base",
+    help = "whisper model size, eg. tiny.en, base.en, small.en or base. smaller is faster but less accurate."
+)
 
-    print(f"Took {round(time.time() - startTime, 2)}s")
+parser.add_argument("-asrDevice",
+    choices = [
+        "cpu",
+        "cuda"
+    ],
+    default = "cpu",
+    help = "device to run speech recognition on"
+)
 
-def ffplay(filename, args = ""):
-    print(f"Playing file {filename}...")
-    return os.system(f"ffplay {args} \"{filename}\" -autoexit -nodisp -hide_banner -loglevel error")
+parser.add_argument("-asrThreads",
+    type = int,
+    default = 0,
+    help = "how many threads speech recognition can use. 0 leaves it up to the backend, which usually uses every core."
+)
 
-def playSound(soundName):
-    print(f"Playing file {soundName}...")
-    return ffplay(f"{soundsDirectory}/{soundName}.wav", f"-af 'volume={flags.soundsVolume}'")
+parser.add_argument("-asrComputeType",
+    type = str,
+    default = "int8",
+    help = "with faster-whisper, the precision the model is run at, eg. int8, int8_float16, float16 or float32"
+)
 
-def playRandomSoundInDirectory(directory):
-    # TODO: might also use os.path.isdir() ?
-    playSound(f"{directory}/{random.choice([f for f in os.listdir(f"{soundsDirectory}/{directory}") if not f.startswith(".")])[:-4]}")
+parser.add_argument("-asrProfile",
+    choices = [
+        "radio",
+        "general"
+    ],
+    default = "radio",
+    help = "radio decodes short transmissions quickly: the language is fixed, there is no fallback decoding, output is capped by the length of the clip and whisper is told which callsigns and codes to expect. general uses whisper's defaults."
+)
 
-def playError():
-    beginTransmit()
-    playRandomSoundInDirectory("error")
-    endTransmit()
+parser.add_argument("-asrLanguage",
+    type = str,
+    default = "en",
+    help = "language transmissions are in, with -asrProfile radio"
+)
 
-def playNoise(lengthSeconds = 5):
-    print(f"Playing noise for {lengthSeconds} seconds...")
-    # does not use ffplay function bc that calls a file
-    os.system(f"ffplay -f lavfi 'anoisesrc=a=0.1:c=white:d={lengthSeconds}' -af 'volume={flags.delayNoiseVolume}' -autoexit -nodisp -hide_banner -loglevel error")
+parser.add_argument("-asrBeamSize",
+    type = int,
+    default = 1,
+    help = "beam size used with -asrProfile radio. 1 is greedy decoding, which is the fastest."
+)
 
-def clearPreviousLine():
-    print("\033[A", end="\r")
-    print("\033[K", end="\r")
+parser.add_argument("-knownUnits",
+    type = str,
+    default = "",
+    help = "comma separated callsigns of units that are likely to call, eg. \"adam 12, lincoln 3\". whisper is told to expect these, along with any unit that has called us."
+)
 
-def getNewRecordingFilename():
-    return f"{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.wav"
+parser.add_argument("-asrSelfTest",
+    type = str,
+    help = "transcribe this recording with every installed asr backend, report how fast each one was, and exit"
+)
 
-def appendToTranscript(text):
-    if flags.dontSaveTranscript is not True:
-        with open(f"{recordingDirectory}/transcript.log", "a") as transcriptFile:
-            transcriptFile.write(f"RX: {text}\n")
+parser.add_argument("-channels",
+    type = str,
+    help = "listen on several radio interfaces at once, each with its own devices, prompt and voices, as listed in this json file. see channel.py"
+)
 
-def openMicrophoneStream():
-    global micStream
+parser.add_argument("-asrBatchSize",
+    type = int,
+    default = 4,
+    help = "max number of transmissions, from any channel, to transcribe together in one batch"
+)
 
-    print("Opening micStream.")
+parser.add_argument("-asrBatchWait",
+    type = float,
+    default = 0,
+    help = "how long to wait for more transmissions to batch with one that's ready to be transcribed, in seconds"
+)
 
-    micStream = p.open(
-        format = pyaudio.paInt16,
-        channels = 1,
-        rate = 44100,
-        input = True,
-        frames_per_buffer = MIC_STREAM_CHUNK_SIZE
-    )
+parser.add_argument("-llmSlots",
+    type = int,
+    default = 1,
+    help = "how many channels can be prompting ollama at the same time"
+)
 
-    # throw away the first chunk of data to avoid
-    # recording being started immediately
-    for x in range(0, flags.initialStreamChunkDiscardCount):
-        micStream.read(MIC_STREAM_CHUNK_SIZE, exception_on_overflow=False)
+parser.add_argument("-ttsSlots",
+    type = int,
+    default = 1,
+    help = "how many channels can be synthesising speech at the same time"
+)
 
-def closeMicStream():
-    global micStream
+parser.add_argument("-debug",
+    action = "store_true",
+    help = "print more debug information"
+)
 
-    print("Closing micStream.")
+flags = parser.parse_args()
 
-    micStream.close()
+print(flags.__dict__)
 
-def processLoop():
-    global lastUnit
-    global lastIdleMessage
-    global lastIdleSpeaker
-    global lastIdleMessageTime
-    global nextIdleMessageDelay
-    global micStream
+# whisper (torch) and piper (onnxruntime) are slow to import, so they're imported
+# by the loader threads below instead of here. see loadAsrEngine and VoicePool
+from archive import Archive
+from asr import ASR_SAMPLE_RATE, WHISPER_WINDOW_SECONDS, createAsrEngine, createDecodingProfile, getInstalledAsrBackends
+from audio import AudioOutput, loadWav, pcmToFloat, readPcmBlocks, resampleAudio
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import json
+import math
+import os
+from batchAsr import createTranscriptionPool, getRecordingPaths, getRecordingStartTime, transcribeSegment
+from benchmark import FileInputSource, NullAudioOutput, StubOllamaServer, TransmissionSegmenter, getPeakRss, summarizeLatencies
+from captureBuffer import CaptureBuffer, Recording
+from channel import Channel, loadChannelConfigs
+from conversation import ConversationMemory
+from intents import IntentRouter, getIntentVocabulary
+from metrics import Metrics
+from ollamaClient import OllamaClient
+from responseCache import ResponseCache
+from speechCache import SpeechCache
+import pyaudio
+import queue
+import random
+import re
+from scheduler import FairScheduler
+import threading
+from streamingAsr import StreamingTranscriber
+from vad import VoiceActivityDetector
+from voicePool import VoicePool
 
-    print("Beginning process loop")
+# how long each part of startup took, in seconds
+startupTimings = {}
 
-    frames = []
-    recording = False
-    recordingStartTime = None
-    lastDetectionTime = time.time()
-    
-    openMicrophoneStream()
+def timeStartup(name, function, *args, **kwargs):
+    startTime = time.time()
+    result = function(*args, **kwargs)
+    startupTimings[name] = time.time() - startTime
+    return result
 
-    print("Started stream, beginning processing...")
+startupTimings["imports"] = time.time() - startupStartTime
 
-    while True:
-        data = micStream.read(MIC_STREAM_CHUNK_SIZE, exception_on_overflow=False)
-
-        currentTime = time.time()
-        timeSinceLastDetection = currentTime - lastDetectionTime
-        
-        level = audioop.rms(data, 2)
-        
-        clearPreviousLine()
-        print(f"Audio level ({timeSinceLastDetection: .1f}s): {level}.")
-
-        # sound is loud enough to record,
-        # or the last detected sound was less than padDuration (eg 2 seconds) ago
-        if level > flags.threshold or (recording and lastDetectionTime + flags.padDuration > currentTime):
-            if not recording:
-                clearPreviousLine()
-                print(f"Sound detected at level {level} (threshold is {flags.threshold}) starting recording...")
-                print("") # new line to prevent audio level from overwriting things
-                recordingStartTime = currentTime  # Initialize the start time
-
-            recording = True
-            frames.append(data)
-
-            if level > flags.threshold:
-                lastDetectionTime = currentTime
-            
-            # Check for max duration
-            if recordingStartTime and currentTime - recordingStartTime >= flags.maxDuration:
-                clearPreviousLine()
-                print("Max duration reached, stopping recording.")
-                recording = False
-        
-        # sound below threshold, or last detection + padDuration was earlier than the current time
-        else:
-            if recording:
-                duration = currentTime - recordingStartTime
+if flags.benchmark is not None or flags.transcribeFiles is not None:
+    # nothing from a benchmark or batch transcription should end up in the archive
+    flags.saveReceivedAudio = False
+    flags.saveTransmittedAudio = False
+    flags.dontSaveTranscript = True
 
-                if lastDetectionTime + flags.padDuration < currentTime:
-                    if duration >= flags.minDuration:
-                        totalProcessStart = time.time()
+if flags.benchmark is not None:
+    if not flags.benchmarkUseOllama:
+        stubOllama = StubOllamaServer()
+        flags.ollamaUri = stubOllama.uri
 
-                        clearPreviousLine()
-                        print(f"Sound stopped at level {level} with duration of {duration: .2f} seconds")
+workingDirectory = os.path.join(os.path.expanduser("~"), "Documents/GitHub/dispatcher")
+recordingDirectory = os.path.join(workingDirectory, "recordings")
+soundsDirectory = os.path.join(workingDirectory, "sounds")
+voicesDirectory = os.path.join(workingDirectory, "voices")
+promptsDirectory = os.path.join(workingDirectory, "prompts")
+cacheDirectory = os.path.join(workingDirectory, "cache")
+
+metrics = Metrics(flags.metricsFile, flags.prometheusFile, flags.metricsInterval)
+
+# recordings and the transcript
+if flags.saveReceivedAudio or flags.saveTransmittedAudio or not flags.dontSaveTranscript:
+    archive = Archive(
+        recordingDirectory,
+        flags.archiveFormat,
+        sampleRate = flags.archiveSampleRate or None,
+        maxBytes = int(flags.archiveMaxSize * 1048576),
+        maxAgeSeconds = flags.archiveMaxAge * 86400,
+        maxTranscriptBytes = int(flags.transcriptMaxSize * 1048576),
+        metrics = metrics
+    )
+else:
+    archive = None
 
-                        closeMicStream()
+# only so that whisper can download different models
+import ssl
+ssl._create_default_https_context = ssl._create_unverified_context
 
-                        # Save the audio
-                        filename = getNewRecordingFilename()
-                        wf = wave.open(f"{recordingDirectory}/rx-{filename}", "wb")
-                        wf.setnchannels(1)
-                        wf.setsampwidth(p.get_sample_size(pyaudio.paInt16))
-                        wf.setframerate(44100)
-                        wf.writeframes(b''.join(frames))
-                        wf.close()
+asrProfile = createDecodingProfile(flags.asrProfile, flags.asrLanguage, flags.asrBeamSize)
 
-                        if not os.path.isfile(f"{recordingDirectory}/rx-{filename}"):
-                            raise Exception("File for received audio did not exist to transcribe.")
-                        
-                        print("Transcribing audio...")
-                
-                        transcribeStartTime = time.time()
+def loadAsrEngine():
+    print(f"Loading asr model: {flags.asrModel} ({flags.asrBackend})")
+    return createAsrEngine(flags.asrBackend, flags.asrModel, flags.asrDevice, flags.asrThreads, flags.asrComputeType, asrProfile)
 
-                        # fp16 is false because it generates a warning (at least on macos)
-                        transcription = whisperModel.transcribe(f"{recordingDirectory}/rx-{filename}", fp16=False)
-                        transcription = transcription["text"].strip(" .,\n").lower()
+# loads each installed backend in turn and reports how fast it transcribes a recording
+def runAsrSelfTest():
+    audio = loadWav(flags.asrSelfTest, ASR_SAMPLE_RATE)
+    results = []
 
-                        print(f"Transcription: \"{transcription}\"")
-                        print(f"Transcription took {(time.time() - transcribeStartTime): .1f}s")
+    print(f"Testing asr backends on {flags.asrSelfTest} ({len(audio) / ASR_SAMPLE_RATE:.1f}s)...")
 
-                        if not flags.saveReceivedAudio:
-                            os.remove(f"{recordingDirectory}/rx-{filename}")
+    for backend in getInstalledAsrBackends():
+        try:
+            startTime = time.time()
+            engine = createAsrEngine(backend, flags.asrModel, flags.asrDevice, flags.asrThreads, flags.asrComputeType, asrProfile)
+            loadSeconds = time.time() - startTime
 
-                        appendToTranscript(f"RX: {transcription}")
+            result = engine.selfTest(audio)
+            result["loadSeconds"] = loadSeconds
+            results.append(result)
 
-                        userMessageHistory.append({
-                            "role": "user",
-                            "content": transcription
-                        })
+            print(f"{backend}: {result['seconds']:.2f}s per pass, realtime factor {result['realtimeFactor']:.3f}, loaded in {loadSeconds:.2f}s. \"{result['text']}\"")
+        except Exception as e:
+            print(f"A {type(e).__name__} exception occurred while testing {backend}:", e)
+
+    return results
+
+if flags.asrSelfTest is not None:
+    runAsrSelfTest()
+    exit()
+
+# the workers have to be forked before pyaudio is set up, see createTranscriptionPool
+if flags.transcribeFiles is not None:
+    transcribeProcesses = flags.transcribeProcesses or os.cpu_count()
+
+    print(f"Starting {transcribeProcesses} transcription processes...")
+
+    transcriptionPool = createTranscriptionPool(
+        transcribeProcesses,
+        flags.asrBackend,
+        flags.asrModel,
+        flags.asrDevice,
+        # the cores are shared between the processes, rather than every process using all of them
+        flags.asrThreads or max(1, os.cpu_count() // transcribeProcesses),
+        flags.asrComputeType,
+        asrProfile
+    )
+
+p = pyaudio.PyAudio()
+MIC_STREAM_CHUNK_SIZE = flags.chunkSize
+
+# the settings for anything a channel in -channels leaves out, and for the only channel when -channels isn't given
+channelDefaults = {
+    "inputDevice": None,
+    "outputDevice": None,
+    "prompt": flags.prompt,
+    "piperVoice": flags.piperVoice,
+    "idleVoice": flags.idleVoice,
+}
+
+if flags.channels is not None:
+    channelConfigs = loadChannelConfigs(flags.channels, channelDefaults)
+else:
+    channelConfigs = [{ **channelDefaults, "name": "main" }]
+
+if (flags.benchmark is not None or flags.transcribeFiles is not None) and len(channelConfigs) > 1:
+    print("Only the first channel is benchmarked or used for batch transcription.")
+    channelConfigs = channelConfigs[:1]
+
+# recordings and the transcript say which channel they came from
+multiChannel = len(channelConfigs) > 1
+
+# in piper, 0.8 is faster and 1.3 is slower.
+# this formula reverses the number so that
+# speed is consistent between gtts and piper
+# 1.3 -> 0.8 and 0.8 -> 1.3 etc
+# only -ttsSlots voices synthesise at once, so they don't need more than their share of the cores each
+ttsThreads = flags.ttsThreads if flags.ttsThreads > 0 else max(1, (os.cpu_count() or 1) // max(1, flags.ttsSlots))
+voicePool = VoicePool(voicesDirectory, int(flags.voicePoolMemory * 1048576), lengthScale = 1 - (flags.voiceSpeed - 1.0), threads = ttsThreads)
+
+# a random dispatcher voice is picked once, so that the dispatcher always sounds the same.
+# a random idle voice is picked again for every idle message (see getSpeakerVoice)
+for config in channelConfigs:
+    if config["piperVoice"] == "random":
+        config["piperVoice"] = voicePool.getRandomVoiceName()
+
+# voices are loaded by the pool when they're first used, these are loaded at startup because they're needed straight away
+voiceNames = sorted(set(config[key] for config in channelConfigs for key in ["piperVoice", "idleVoice"]) - { "random" })
+
+# the models are loaded at the same time on their own threads, while the mic is opened and starts listening.
+# anything that needs a model waits for it with waitForModels.
+modelLoader = concurrent.futures.ThreadPoolExecutor(max_workers = 1 + len(voiceNames), thread_name_prefix = "modelLoader")
+
+# batch transcription decodes in its worker processes and doesn't speak, so it doesn't need either
+if flags.transcribeFiles is None:
+    asrEngineFuture = modelLoader.submit(timeStartup, "asr", loadAsrEngine)
+    voiceFutures = { name: modelLoader.submit(timeStartup, f"voice {name}", voicePool.get, name) for name in voiceNames }
+
+    modelFutures = {
+        "asr": asrEngineFuture,
+        **{ f"voice {name}": future for name, future in voiceFutures.items() },
+    }
+else:
+    modelFutures = {}
+
+# makes sure the channel's voices and the asr engine are ready
+def waitForModels(channel):
+    voiceFutures[channel.voiceName].result()
+
+    if channel.idleVoiceName in voiceFutures:
+        voiceFutures[channel.idleVoiceName].result()
+
+    asrEngineFuture.result()
+
+def getAsrEngine():
+    return asrEngineFuture.result()
+
+# there's nothing we can do without the models, so give up if one of them fails to load
+def checkModelLoaded(future):
+    if future.exception() is not None:
+        name = [name for name, modelFuture in modelFutures.items() if modelFuture is future][0]
+        print(f"Failed to load {name}: {future.exception()}")
+        os._exit(1)
+
+for future in modelFutures.values():
+    future.add_done_callback(checkModelLoaded)
+
+def reportStartup():
+    concurrent.futures.wait(modelFutures.values())
+
+    startupTimings["total"] = time.time() - startupStartTime
+
+    print("Startup timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startupTimings.items()))
+    print("") # new line to prevent audio level from overwriting things
+
+    if flags.startupReport is not None:
+        with open(flags.startupReport, "w") as reportFile:
+            json.dump(startupTimings, reportFile, indent = 4)
+
+# the benchmark measures synthesis, so it doesn't use the cache
+if flags.benchmark is None and (flags.speechCacheMemory > 0 or flags.speechCacheSize > 0):
+    speechCache = timeStartup("speech cache", SpeechCache, f"{cacheDirectory}/speech", int(flags.speechCacheMemory * 1048576), int(flags.speechCacheSize * 1048576))
+else:
+    speechCache = None
+
+# the benchmark measures the llm (or the stub), so it doesn't use the cache either
+if flags.benchmark is None and flags.responseCacheSize > 0:
+    responseCache = ResponseCache(flags.responseCacheSize, flags.responseCacheTtl, max(1, flags.responseCacheVariants))
+else:
+    responseCache = None
+
+# responses that don't change, these can be synthesised ahead of time
+cannedResponses = {
+    "goahead": "control, goahead",
+    "innoculated": "Innoculation complete.",
+}
+
+# what units can say to us. phrases (and aliases) are combined with each of their prefixes.
+# phrases are spelled the way whisper should write them, aliases are the ways it gets them wrong.
+intentTable = {
+    "reset": {
+        "phrases": [
+            "innoculate shield pacify",
+        ],
+        # a passphrase, whisper shouldn't be expecting it
+        "vocabulary": False,
+    },
+    "available": {
+        "prefixes": [
+            "i'm",
+            "show me",
+            "show us",
+            "we're",
+        ],
+        "phrases": [
+            "10-8",
+            "available",
+            "in service",
+        ],
+        "aliases": [
+            "108",
+            "ten eight",
+            "tonight",
+        ],
+    },
+    "unavailable": {
+        "prefixes": [
+            "i'm",
+            "show me",
+            "show us",
+            "we're",
+        ],
+        "phrases": [
+            "10-7",
+            "unavailable",
+            "out of service",
+        ],
+        "aliases": [
+            "107",
+            "ten seven",
+        ],
+    },
+    # "{unit} control", acquires the unit who is speaking
+    "callsign": {
+        "suffix": "control",
+        "slot": "unit",
+        # the vocabulary prompt already starts with it
+        "vocabulary": False,
+    },
+    "clear": {
+        "suffix": "clear",
+        "slot": "unit",
+    },
+}
+
+intentRouter = timeStartup("intent router", IntentRouter, intentTable, flags.intentMaxDistance)
+
+# codes and phrases whisper should expect, written the way the intent table spells them
+radioVocabulary = getIntentVocabulary(intentTable)
+
+# callsigns from -knownUnits, and the most recent units to call us on any channel
+knownUnits = [unit.strip().lower() for unit in flags.knownUnits.split(",") if len(unit.strip()) > 0]
+heardUnits = collections.OrderedDict()
+heardUnitsLock = threading.Lock()
+MAX_HEARD_UNITS = 20
+
+# a callsign is a few letters and numbers (eg. "adam 12"). anything else in front of "control",
+# or nothing at all, isn't worth suggesting to whisper
+def isCallsign(unit):
+    return re.fullmatch(r"[a-z0-9]+( [a-z0-9]+){0,2}", unit) is not None
+
+def addHeardUnit(unit):
+    if not isCallsign(unit):
+        return
+
+    with heardUnitsLock:
+        heardUnits[unit] = True
+        heardUnits.move_to_end(unit)
+
+        while len(heardUnits) > MAX_HEARD_UNITS:
+            heardUnits.popitem(last = False)
+
+# given to whisper as the text before each transmission, so that it spells callsigns and codes the way we expect them.
+# eg. "10-8" rather than "tonight". only used with the radio profile.
+def getVocabularyPrompt():
+    if flags.asrProfile != "radio":
+        return None
+
+    with heardUnitsLock:
+        units = list(dict.fromkeys(knownUnits + list(reversed(heardUnits))))
+
+    return "Control, " + ", ".join(units + radioVocabulary) + "."
+
+# ollama and piper are shared by every channel, these make sure each channel gets its turn
+llmScheduler = FairScheduler("llm", flags.llmSlots)
+ttsScheduler = FairScheduler("tts", flags.ttsSlots)
+
+def beginTransmit(channel):
+    channel.bargeIn.clear()
+    channel.transmitting.set()
+    channel.transmitStartTime = time.time()
+
+    if flags.delayNoise is not None and flags.delayNoise > 0:
+        playNoise(channel, lengthSeconds = flags.delayNoise)
+    elif flags.delay is not None:
+        channel.audioOutput.playSilence(flags.delay)
+
+    if flags.mdcStart is not None:
+        if flags.mdcStart == "random":
+            playRandomSoundInDirectory(channel, "mdc")
+        else:
+            playSound(channel, f"mdc/{flags.mdcStart}")
+
+def playEndTone(channel):
+    if flags.mdcEnd is not None:
+        if flags.mdcEnd == "random":
+            playRandomSoundInDirectory(channel, "mdc")
+        else:
+            playSound(channel, f"mdc/{flags.mdcEnd}")
+
+def endTransmit(channel):
+    generation = channel.audioOutput.generation
+    playEndTone(channel)
+
+    # sounds are queued, so wait for them to actually finish before we unkey
+    channel.audioOutput.wait()
+
+    # a unit broke in while we were waiting, which cut off the end tone along with everything else
+    if channel.audioOutput.generation != generation:
+        playEndTone(channel)
+        channel.audioOutput.wait()
+
+    channel.transmitting.clear()
+
+    metrics.observe("playback", time.time() - channel.transmitStartTime, channel = channel.name)
+
+ollama = OllamaClient(
+    flags.ollamaUri,
+    flags.ollamaModel,
+    keepAlive = int(flags.ollamaKeepAlive) if flags.ollamaKeepAlive.lstrip("-").isdigit() else flags.ollamaKeepAlive,
+    connectTimeout = flags.ollamaConnectTimeout,
+    readTimeout = flags.ollamaTimeout,
+    retries = flags.ollamaRetries,
+    debug = flags.debug
+)
+
+# returns what the llm said the last time it was given the same traffic, or None if it has to be asked
+def getCachedResponse(messageHistory, channel):
+    if responseCache is None:
+        return None
+
+    response = responseCache.get(messageHistory)
+
+    metrics.increment("responseCacheHits" if response is not None else "responseCacheMisses", channel = channel.name)
+    metrics.setGauge("responseCacheHitRate", responseCache.getHitRate())
+
+    if flags.debug:
+        print(responseCache.getStatus())
+
+    return response
+
+def cacheResponse(messageHistory, response):
+    if responseCache is not None and len(response) > 0:
+        responseCache.put(messageHistory, response)
+
+# cacheable is False for anything that isn't radio traffic (eg. summaries), which is never repeated
+def promptResponse(messageHistory, channel, cacheable = True):
+    if cacheable:
+        response = getCachedResponse(messageHistory, channel)
+
+        if response is not None:
+            print(f"[{channel.name}] Cached response: {response}")
+            return response
+
+    waitStartTime = time.time()
+
+    with llmScheduler.use(channel):
+        metrics.observe("llmWait", time.time() - waitStartTime, channel = channel.name)
+
+        startTime = time.time()
+
+        print(f"[{channel.name}] Prompting response...")
+
+        response = ollama.chat(messageHistory).strip()
+
+    metrics.observe("llm", time.time() - startTime, channel = channel.name)
+    print(f"Reponse took {round(time.time() - startTime, 2)}s to generate.")
+
+    if cacheable:
+        cacheResponse(messageHistory, response)
+
+    print(f"[{channel.name}] Response: {response}")
+    return response
+
+# matches the whitespace after the end of a sentence
+sentenceBoundary = re.compile(r"(?<=[.!?])\s+")
+
+# yields the response one sentence at a time as ollama generates it,
+# so that speakResponse can begin synthesising before the model is finished.
+# the channel keeps its turn with ollama until the whole response has been generated.
+# setting cancelled stops generating (closing the request, so ollama stops too) and gives up the turn.
+def promptResponseStream(messageHistory, channel, cancelled = None):
+    cached = getCachedResponse(messageHistory, channel)
+
+    if cached is not None:
+        print(f"[{channel.name}] Cached response: {cached}")
+
+        for sentence in sentenceBoundary.split(cached):
+            if len(sentence.strip()) > 0:
+                yield sentence.strip()
+        return
+
+    waitStartTime = time.time()
+
+    with llmScheduler.use(channel):
+        metrics.observe("llmWait", time.time() - waitStartTime, channel = channel.name)
+
+        startTime = time.time()
+        firstSentenceTime = None
+
+        print(f"[{channel.name}] Prompting streamed response...")
+
+        pending = ""
+        response = ""
+
+        if cancelled is not None and cancelled.is_set():
+            return
+
+        tokens = ollama.chatStream(messageHistory)
+
+        for token in tokens:
+            if cancelled is not None and cancelled.is_set():
+                tokens.close()
+                return
+
+            pending += token
+            response += token
+
+            sentences = sentenceBoundary.split(pending)
+            pending = sentences.pop()
+
+            for sentence in sentences:
+                sentence = sentence.strip()
+                if len(sentence) > 0:
+                    if firstSentenceTime is None:
+                        firstSentenceTime = time.time()
+                    yield sentence
+
+    pending = pending.strip()
+    if len(pending) > 0:
+        if firstSentenceTime is None:
+            firstSentenceTime = time.time()
+        yield pending
+
+    if firstSentenceTime is None:
+        raise Exception("Message from model was empty.")
+
+    metrics.observe("llm", time.time() - startTime, channel = channel.name)
+    metrics.observe("llmFirstSentence", firstSentenceTime - startTime, channel = channel.name)
+    print(f"Reponse took {round(time.time() - startTime, 2)}s to generate (first sentence after {round(firstSentenceTime - startTime, 2)}s).")
+    print(f"[{channel.name}] Response: {response.strip()}")
+
+    cacheResponse(messageHistory, response.strip())
+
+# folds old messages into a summary for ConversationMemory
+def summarizeConversation(channel, summary, messages):
+    conversationText = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+
+    if summary is not None:
+        conversationText = f"Earlier summary: {summary}\n\n{conversationText}"
+
+    return promptResponse([
+        {
+            "role": "system",
+            "content": "Summarise the following radio conversation in no more than three sentences. Keep unit names, statuses and anything that was asked for. Reply with only the summary."
+        },
+        {
+            "role": "user",
+            "content": conversationText
+        }
+    ], channel, cacheable = False)
+
+def resetMessageHistory(channel):
+    channel.conversation.resetAll()
+    print(f"[{channel.name}] Message history reset.")
+
+# synthesises sentences on its own thread, ahead of playback, so that the first sentence is being synthesised while
+# the noise and mdc tone play, and later sentences (and the llm generating them) don't wait for earlier ones to play.
+# puts ("sentence", text) before each sentence's audio, ("audio", pcm) for each chunk of it,
+# then ("done", None) or ("error", exception) on output.
+def synthesisWorker(channel, sentences, voice, output, stop):
+    try:
+        for sentence in sentences:
+            if stop.is_set():
+                break
+
+            sentence = sentence.replace("*", "")
+            output.put(("sentence", sentence))
+
+            # voice speed is changed using piper's length_scale rather than resampling the output
+            for byteData in synthesizeSpeech(channel, sentence, voice):
+                output.put(("audio", byteData))
+
+                if stop.is_set():
+                    break
+
+        output.put(("done", None))
+    except Exception as e:
+        output.put(("error", e))
+
+# text may be a string, or an iterable of sentences (see promptResponseStream)
+# returns the text that was actually spoken. if a unit broke in, that's only the sentences that had started playing.
+def speakResponse(channel, text, voice):
+    startTime = time.time()
+
+    print("Generating response audio...")
+
+    if isinstance(text, str):
+        sentences = iter([text])
+    else:
+        sentences = iter(text)
+
+    # wait for the first sentence before keying up,
+    # so that we don't transmit dead air while the llm is thinking.
+    firstSentence = next(sentences, None)
+
+    if firstSentence is None:
+        raise Exception("There was no text to speak.")
+
+    print("Generating speech...")
+
+    synthesized = queue.Queue()
+    stopSynthesis = threading.Event()
+    threading.Thread(target = synthesisWorker, args = (channel, itertools.chain([firstSentence], sentences), voice, synthesized, stopSynthesis), name = f"synthesis-{channel.name}", daemon = True).start()
+
+    try:
+        # the noise and tone are queued, speech is queued behind them as soon as it's ready
+        beginTransmit(channel)
+
+        firstAudioTime = None
+        # sentences are added once they start playing, not when they're synthesised
+        spoken = []
+        # what was said, for the archive
+        transmittedAudio = []
+
+        while True:
+            # anything that was queued has already been cut off, this stops anything after it
+            if channel.bargeIn.is_set():
+                print(f"[{channel.name}] A unit broke in, stopping transmission.")
+                channel.audioOutput.cancel()
+                break
+
+            try:
+                kind, value = synthesized.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+
+            if kind == "done":
+                break
+            elif kind == "error":
+                raise value
+            elif kind == "sentence":
+                # it starts playing once everything queued before it has played. if a unit breaks in first, it never does
+                channel.audioOutput.onPlayed(lambda sentence = value: spoken.append(sentence))
+                continue
+
+            if firstAudioTime is None:
+                firstAudioTime = time.time()
+                metrics.observe("ttsFirstByte", firstAudioTime - startTime, channel = channel.name)
+                print(f"Time to first audio: {round(firstAudioTime - startTime, 2)}s")
+
+            channel.audioOutput.playPcm(value, voice.config.sample_rate, flags.voiceVolume)
+
+            if flags.saveTransmittedAudio:
+                transmittedAudio.append(value)
+
+        endTransmit(channel)
+    finally:
+        stopSynthesis.set()
+
+    if flags.saveTransmittedAudio:
+        archive.saveAudio(getNewRecordingName(channel, "tx"), b"".join(transmittedAudio), voice.config.sample_rate)
+
+    print(f"Took {round(time.time() - startTime, 2)}s")
+
+    if speechCache is not None:
+        print(speechCache.getStatus())
+
+    return " ".join(spoken)
+
+# yields raw pcm for text, from the speech cache if it's been said before.
+# the channel keeps its turn with piper until the text has been synthesised, playback is queued so this is quick.
+def synthesizeSpeech(channel, text, voice):
+    if speechCache is None:
+        with ttsScheduler.use(channel):
+            yield from voice.synthesize_stream_raw(text)
+        return
+
+    cached = speechCache.get(voice.modelName, voice.config.length_scale, text)
+
+    if cached is not None:
+        yield cached[1]
+        return
+
+    chunks = []
+
+    with ttsScheduler.use(channel):
+        for byteData in voice.synthesize_stream_raw(text):
+            chunks.append(byteData)
+            yield byteData
+
+    speechCache.put(voice.modelName, voice.config.length_scale, text, voice.config.sample_rate, b"".join(chunks))
+
+def prewarmSpeechCache():
+    startTime = time.time()
+
+    for channel in channels:
+        waitForModels(channel)
+
+        for response in cannedResponses.values():
+            for byteData in synthesizeSpeech(channel, response, voicePool.get(channel.voiceName)):
+                pass
+
+    print(f"Speech cache prewarmed in {round(time.time() - startTime, 2)}s")
+
+def playSound(channel, soundName):
+    print(f"Playing sound {soundName}...")
+    channel.audioOutput.playSound(soundName, flags.soundsVolume)
+
+def playRandomSoundInDirectory(channel, directory):
+    playSound(channel, random.choice(channel.audioOutput.getSoundNames(directory)))
+
+def playError(channel):
+    beginTransmit(channel)
+    playRandomSoundInDirectory(channel, "error")
+    endTransmit(channel)
+
+def playNoise(channel, lengthSeconds = 5):
+    print(f"Playing noise for {lengthSeconds} seconds...")
+    channel.audioOutput.playNoise(lengthSeconds, flags.delayNoiseVolume)
+
+def clearPreviousLine():
+    print("\033[A", end="\r")
+    print("\033[K", end="\r")
+
+# direction is "rx" or "tx". the archive adds the extension
+# startTime is when the recording started, if it isn't now
+def getNewRecordingName(channel, direction, startTime = None):
+    timestamp = (startTime or datetime.datetime.now()).strftime("%Y-%m-%d_%H-%M-%S")
+
+    if multiChannel:
+        return f"{direction}-{channel.name}-{timestamp}"
+
+    return f"{direction}-{timestamp}"
+
+# text already says whether it was received or transmitted, eg. "RX: ..."
+def appendToTranscript(channel, text):
+    if flags.dontSaveTranscript is not True:
+        if multiChannel:
+            text = f"[{channel.name}] {text}"
+
+        archive.appendTranscript(text)
+
+def openMicrophoneStream(channel):
+    print(f"[{channel.name}] Opening micStream.")
+
+    # throw away the first chunks of data to avoid
+    # recording being started immediately
+    channel.discardChunks = flags.initialStreamChunkDiscardCount
+
+    # nothing reads the stream, portaudio calls onMicChunk from its own thread as each chunk arrives
+    channel.micStream = p.open(
+        format = pyaudio.paInt16,
+        channels = 1,
+        rate = flags.captureRate,
+        input = True,
+        input_device_index = channel.inputDevice,
+        frames_per_buffer = MIC_STREAM_CHUNK_SIZE,
+        stream_callback = lambda data, frameCount, timeInfo, status: onMicChunk(channel, data, status)
+    )
+
+    if "mic open" not in startupTimings:
+        # time since the program started, rather than how long opening took
+        startupTimings["mic open"] = time.time() - startupStartTime
+
+def closeMicStream(channel):
+    print(f"[{channel.name}] Closing micStream.")
+
+    channel.micStream.stop_stream()
+    channel.micStream.close()
+
+# the pipeline is made of stages, each running on its own thread and connected by bounded queues:
+#  capture: portaudio's callback hands chunks to processLoop, which finds transmissions in them
+#  transcription: saves and transcribes completed transmissions
+#  reply: works out what to say and transmits it (including idle chatter)
+#  idle timer: sleeps until an idle message is due, and hands it to the reply stage
+# the mic stays open the whole time, so nothing is missed while we're busy. every stage waits on its queue
+# (or timer) rather than polling, and catches its own exceptions, so a failure in one of them doesn't stop the others.
+#
+# every channel has its own capture, processLoop, reply and idle timer threads.
+# there's only one transcription thread, which all of the channels share.
+
+# completed transmissions waiting to be transcribed, from every channel
+transmissionQueue = queue.Queue()
+
+def getPipelineStatus(channel):
+    metrics.setGauge("chunkQueueDepth", sum(channel.chunkQueue.qsize() for channel in channels))
+    metrics.setGauge("transmissionQueueDepth", transmissionQueue.qsize())
+    metrics.setGauge("replyQueueDepth", sum(channel.replyQueue.qsize() for channel in channels))
+    metrics.setGauge("llmWaiting", llmScheduler.getWaitingCount())
+    metrics.setGauge("ttsWaiting", ttsScheduler.getWaitingCount())
+
+    return f"queues: chunks {channel.chunkQueue.qsize()}, rx {transmissionQueue.qsize()}, reply {channel.replyQueue.qsize()}. dropped: chunks {metrics.getCounter('droppedChunks')}, rx {metrics.getCounter('droppedTransmissions')}"
+
+# called by portaudio for every chunk from the mic. this runs on portaudio's thread, so it can't block.
+def onMicChunk(channel, data, status):
+    if status & pyaudio.paInputOverflow:
+        # portaudio had to throw some audio away before we got it
+        metrics.increment("inputOverflows", channel = channel.name)
+
+    if channel.discardChunks > 0:
+        channel.discardChunks -= 1
+        return (None, pyaudio.paContinue)
+
+    try:
+        channel.chunkQueue.put_nowait((time.time(), data))
+    except queue.Full:
+        # processLoop has fallen behind, throw away the oldest chunk rather than block the mic
+        try:
+            channel.chunkQueue.get_nowait()
+        except queue.Empty:
+            pass
+
+        channel.chunkQueue.put_nowait((time.time(), data))
+        metrics.increment("droppedChunks", channel = channel.name)
+
+    return (None, pyaudio.paContinue)
+
+def dropTransmission(transmission):
+    metrics.increment("droppedTransmissions", channel = transmission["channel"].name)
+
+    if transmission.get("transcriber") is not None:
+        transmission["transcriber"].cancel()
+
+def queueTransmission(transmission):
+    metrics.increment("transmissions", channel = transmission["channel"].name)
+
+    if transmission["overlappedTransmit"]:
+        metrics.increment("overlappedTransmissions", channel = transmission["channel"].name)
+
+        if flags.transmitOverlapPolicy == "drop":
+            print("Transmission was received while we were transmitting, dropping it.")
+            dropTransmission(transmission)
+            return
+
+    # the limit is per channel, so a busy channel can't push out another channel's traffic
+    with transmissionQueue.mutex:
+        waiting = [queued for queued in transmissionQueue.queue if queued["channel"] is transmission["channel"]]
+
+        # keep the newest traffic, it's what the unit is waiting on
+        oldest = waiting[0] if len(waiting) >= flags.maxQueuedTransmissions else None
+
+        if oldest is not None:
+            transmissionQueue.queue.remove(oldest)
+
+    if oldest is not None:
+        print(f"[{transmission['channel'].name}] Too many transmissions waiting, dropping the oldest one.")
+        dropTransmission(oldest)
+
+    transmissionQueue.put(transmission)
 
-                        if len(transcription) > 0:
-                            if transcription == "innoculate shield pacify":
-                                resetMessageHistory()
-                                response = "Innoculation complete."
-                            # acquires the unit who is speaking, for use later
-                            elif transcription.endswith("control"):
-                                lastUnit = transcription[0:transcription.find("control")]
-                                resetMessageHistory()
-                                response = "control, goahead"
-                            # if we're in a conversation with a specific unit
-                            elif lastUnit is not None:
-                                if availablePhrases.count(transcription):
-                                    response = f"control is clear {lastUnit}, you're in service"
-                                elif unavailablePhrases.count(transcription):
-                                    response = f"control is clear {lastUnit}, you're out of service"
-                                elif transcription.endswith("clear"):
-                                    lastUnit = None
-                                    continue # TODO: this causes an exception to be thrown, but that's okay because it sounds cool.
-                                else: # repeat back what they said
-                                    response = lastUnit + " unable to copy, please say again."
-                            else: # repeat back what they said
-                                response = promptResponse(userMessageHistory)
-
-                            appendToTranscript(f"TX: {response}")
-
-                            userMessageHistory.append({
-                                "role": "assistant",
-                                "content": response
-                            })
-
-                            speakResponse(response, dispatcherVoice)
-
-                        # if the length of the transcription is zero,
-                        # check to see if we got an audio file at all.
-                        #elif os.path.isfile(f"{recordingDirectory}/rx-{filename}"):
-                        #    # rename the received audio to failed so we know. failed can't come after filename because filename contains .wav
-                        #    os.rename(f"{recordingDirectory}/rx-{filename}", f"{recordingDirectory}/rx-failed-{filename}")
-
-                        #    playError()
-
-                        print(f"Total processing time: {round(time.time() - totalProcessStart, 2)}s")
+# converts captured int16 pcm (eg. a view of a Recording) into the float32 16khz array the asr engine expects
+def samplesToWhisperAudio(samples, sampleRate):
+    return resampleAudio(pcmToFloat(samples), sampleRate, ASR_SAMPLE_RATE)
+
+# the asr engine is shared between the transcription worker and streaming transcription,
+# only let one of them use it at a time
+asrLock = threading.Lock()
+
+# returns (start, end, text) for each segment, for StreamingTranscriber
+def transcribeSegments(audio, prompt = None):
+    # what's already been said goes after the vocabulary, closest to the audio
+    prompt = " ".join(text for text in [getVocabularyPrompt(), prompt] if text is not None) or None
+
+    with asrLock:
+        return getAsrEngine().transcribe(audio, prompt)[1]
+
+def transcribeAudio(audio):
+    with asrLock:
+        return getAsrEngine().transcribe(audio, getVocabularyPrompt(), timestamps = False)[0]
+
+def transcribeBatch(audios):
+    with asrLock:
+        return getAsrEngine().transcribeBatch(audios, getVocabularyPrompt())
+
+def createStreamingTranscriber(frames):
+    return StreamingTranscriber(
+        frames,
+        transcribeSegments,
+        lambda samples: samplesToWhisperAudio(samples, flags.captureRate),
+        flags.captureRate,
+        MIC_STREAM_CHUNK_SIZE,
+        stepSeconds = flags.streamingStep,
+        windowSeconds = flags.streamingWindow
+    )
+
+# returns the transcription of each transmission.
+# transmissions from several channels that are waiting at the same time are batched together.
+def transcribeTransmissions(transmissions):
+    if flags.saveReceivedAudio:
+        for transmission in transmissions:
+            samples = transmission["frames"].getSamples()
+
+            # named after when it started (including the pre-roll) rather than when it reached us,
+            # which is after the whole transmission and however long it waited in the queue
+            startTime = datetime.datetime.fromtimestamp(transmission["totalProcessStart"] - len(samples) / flags.captureRate)
+
+            archive.saveAudio(getNewRecordingName(transmission["channel"], "rx", startTime), samples, flags.captureRate)
+
+    print(f"Transcribing audio ({len(transmissions)} transmissions)..." if len(transmissions) > 1 else "Transcribing audio...")
+
+    transcribeStartTime = time.time()
+
+    transcriptions = [None] * len(transmissions)
+    # (index, audio) for everything that can be decoded together
+    batch = []
+
+    for i, transmission in enumerate(transmissions):
+        if transmission.get("transcriber") is not None:
+            # most of it has already been transcribed while it was being received
+            transcriptions[i] = transmission["transcriber"].finish()
+            continue
+
+        audio = samplesToWhisperAudio(transmission["frames"].getSamples(), flags.captureRate)
+
+        if len(audio) <= ASR_SAMPLE_RATE * WHISPER_WINDOW_SECONDS:
+            batch.append((i, audio))
+        else:
+            transcriptions[i] = transcribeAudio(audio)
+
+    if len(batch) == 1:
+        i, audio = batch[0]
+        transcriptions[i] = transcribeAudio(audio)
+    elif len(batch) > 1:
+        # otherwise the engine just goes through them one at a time
+        if getAsrEngine().supportsBatching:
+            metrics.increment("asrBatches")
+            metrics.increment("asrBatchedTransmissions", len(batch))
+
+        for (i, audio), transcription in zip(batch, transcribeBatch([audio for i, audio in batch])):
+            transcriptions[i] = transcription
+
+    for i, transmission in enumerate(transmissions):
+        transcriptions[i] = transcriptions[i].strip(" .,\n").lower()
+
+        print(f"[{transmission['channel'].name}] Transcription: \"{transcriptions[i]}\"")
+        metrics.observe("asr", time.time() - transcribeStartTime, channel = transmission["channel"].name)
+
+    print(f"Transcription took {(time.time() - transcribeStartTime): .1f}s")
+
+    return transcriptions
+
+def transcribeTransmission(transmission):
+    return transcribeTransmissions([transmission])[0]
+
+# waits for a transmission, then takes anything else that's waiting (up to -asrBatchSize) along with it
+def getTranscriptionBatch():
+    transmissions = [transmissionQueue.get()]
+    deadline = time.time() + flags.asrBatchWait
+
+    while len(transmissions) < flags.asrBatchSize:
+        try:
+            transmissions.append(transmissionQueue.get(timeout = max(0, deadline - time.time())))
+        except queue.Empty:
+            break
+
+    return transmissions
+
+def transcriptionWorker():
+    while True:
+        transmissions = getTranscriptionBatch()
+
+        try:
+            transcriptions = transcribeTransmissions(transmissions)
+        except Exception as e:
+            print(f"A {type(e).__name__} exception occurred while transcribing:", e)
+            metrics.increment("errors", stage = "asr")
+
+            # the reply workers own the transmitters
+            for transmission in transmissions:
+                transmission["channel"].replyQueue.put(("error", None, None))
+
+            continue
+
+        for transmission, transcription in zip(transmissions, transcriptions):
+            transmission["channel"].replyQueue.put(("rx", transcription, transmission["totalProcessStart"]))
+
+# works out what to say back to a transcription.
+# returns (intent, response). response is None if we shouldn't reply, or a generator of sentences if it's being streamed.
+def generateResponse(channel, transcription):
+    intent, slots = intentRouter.match(transcription)
+
+    if flags.debug:
+        print(f"Intent: {intent} {slots}")
+
+    # a unit calling us starts (or continues) the conversation with that unit
+    channel.conversation.addMessage(slots["unit"] if intent == "callsign" else channel.lastUnit, "user", transcription)
+
+    if intent == "reset":
+        resetMessageHistory(channel)
+        response = cannedResponses["innoculated"]
+    # acquires the unit who is speaking, for use later
+    elif intent == "callsign":
+        channel.lastUnit = slots["unit"]
+        addHeardUnit(channel.lastUnit)
+        response = cannedResponses["goahead"]
+    # if we're in a conversation with a specific unit
+    elif channel.lastUnit is not None:
+        if intent == "available":
+            response = f"control is clear {channel.lastUnit}, you're in service"
+        elif intent == "unavailable":
+            response = f"control is clear {channel.lastUnit}, you're out of service"
+        elif intent == "clear":
+            channel.lastUnit = None
+            response = None
+        else: # repeat back what they said
+            response = channel.lastUnit + " unable to copy, please say again."
+    elif flags.streamResponse:
+        response = promptResponseStream(channel.conversation.getMessages(channel.lastUnit), channel)
+    else: # repeat back what they said
+        response = promptResponse(channel.conversation.getMessages(channel.lastUnit), channel)
+
+    return intent, response
+
+def respondToTransmission(channel, transcription, totalProcessStart):
+    appendToTranscript(channel, f"RX: {transcription}")
+
+    if len(transcription) > 0:
+        intent, response = generateResponse(channel, transcription)
+
+        if response is not None:
+            # what was actually said, which is less than the whole response if a unit broke in
+            response = speakResponse(channel, response, voicePool.get(channel.voiceName))
+
+            if len(response) > 0:
+                appendToTranscript(channel, f"TX: {response}")
+
+                if intent != "reset":
+                    channel.conversation.addMessage(channel.lastUnit, "assistant", response)
+
+            if flags.debug:
+                print(channel.conversation.getStatus(channel.lastUnit))
+
+    # if the length of the transcription is zero,
+    # check to see if we got an audio file at all.
+    #elif os.path.isfile(f"{recordingDirectory}/rx-{filename}"):
+    #    # rename the received audio to failed so we know. failed can't come after filename because filename contains .wav
+    #    os.rename(f"{recordingDirectory}/rx-{filename}", f"{recordingDirectory}/rx-failed-{filename}")
+
+    #    playError()
+
+    metrics.observe("turnaround", time.time() - totalProcessStart, channel = channel.name)
+    print(f"Total processing time: {round(time.time() - totalProcessStart, 2)}s")
+
+# idle chatter is between the dispatcher and someone else, "dispatcher" or "idle"
+def getNextIdleSpeaker(channel):
+    if channel.lastIdleSpeaker == "idle":
+        return "dispatcher"
+    else:
+        return "idle"
+
+def getSpeakerVoice(channel, speaker):
+    if speaker == "dispatcher":
+        return voicePool.get(channel.voiceName)
+
+    # someone different every time
+    if channel.idleVoiceName == "random":
+        return voicePool.get(voicePool.getRandomVoiceName(exclude = channel.voiceName))
+
+    return voicePool.get(channel.idleVoiceName)
+
+def getIdleMessages(channel, speaker, message):
+    return [
+        {
+            "role": "system",
+            "content": channel.prompt["primary"]
+        },
+        {
+            "role": "system",
+            "content": "Reply to the next message with this context: " + channel.prompt["idle1"] if speaker == "dispatcher" else channel.prompt["idle2"]
+        },
+        {
+            "role": "user",
+            "content": message
+        }
+    ]
+
+def speculateIdleMessage(channel):
+    speculation = {
+        "speaker": getNextIdleSpeaker(channel),
+        # picked by renderIdleSpeculation, as it might have to be loaded
+        "voice": None,
+        "replyingTo": channel.lastIdleMessage,
+        "text": None,
+        "pcm": None,
+        "ready": threading.Event(),
+        "cancelled": threading.Event(),
+    }
+
+    with channel.idleSpeculationLock:
+        channel.idleSpeculation = speculation
+
+    threading.Thread(target = renderIdleSpeculation, args = (channel, speculation), name = f"idleSpeculation-{channel.name}", daemon = True).start()
+
+def renderIdleSpeculation(channel, speculation):
+    startTime = time.time()
+
+    try:
+        speculation["voice"] = getSpeakerVoice(channel, speculation["speaker"])
+
+        # streamed so that it can be stopped part way through, rather than holding up real traffic waiting for ollama
+        sentences = list(promptResponseStream(getIdleMessages(channel, speculation["speaker"], speculation["replyingTo"]), channel, speculation["cancelled"]))
+
+        if speculation["cancelled"].is_set():
+            return
+
+        chunks = []
+
+        for sentence in sentences:
+            speech = synthesizeSpeech(channel, sentence.replace("*", ""), speculation["voice"])
+
+            for byteData in speech:
+                if speculation["cancelled"].is_set():
+                    # gives piper back to whoever is waiting for it
+                    speech.close()
+                    return
+
+                chunks.append(byteData)
+
+        speculation["text"] = " ".join(sentences)
+        speculation["pcm"] = b"".join(chunks)
+
+        print(f"[{channel.name}] Next idle message ready in {round(time.time() - startTime, 2)}s")
+    except Exception as e:
+        print(f"A {type(e).__name__} exception occurred while preparing the next idle message:", e)
+    finally:
+        speculation["ready"].set()
+
+# real traffic takes priority, so throw away the idle message being prepared.
+# renderIdleSpeculation stops as soon as it sees it's been cancelled, giving up its turn with ollama or piper
+def discardIdleSpeculation(channel):
+    with channel.idleSpeculationLock:
+        if channel.idleSpeculation is not None:
+            channel.idleSpeculation["cancelled"].set()
+            channel.idleSpeculation = None
+            print(f"[{channel.name}] Discarded the next idle message.")
+
+def takeIdleSpeculation(channel):
+    with channel.idleSpeculationLock:
+        speculation = channel.idleSpeculation
+        channel.idleSpeculation = None
+
+    return speculation
+
+# plays audio that has already been synthesised
+def speakAudio(channel, pcm, voice):
+    startTime = time.time()
+
+    beginTransmit(channel)
+    channel.audioOutput.playPcm(pcm, voice.config.sample_rate, flags.voiceVolume)
+    endTransmit(channel)
+
+    if flags.saveTransmittedAudio:
+        archive.saveAudio(getNewRecordingName(channel, "tx"), pcm, voice.config.sample_rate)
+
+    print(f"Took {round(time.time() - startTime, 2)}s")
+
+def respondToIdleMessage(channel):
+    print(f"[{channel.name}] Responding to last idle message.")
+
+    speculation = takeIdleSpeculation(channel)
+
+    if speculation is not None:
+        # it's usually ready by now, but if it isn't it's still closer to done than starting again
+        speculation["ready"].wait()
+
+    if speculation is not None and speculation["pcm"] is not None and not speculation["cancelled"].is_set():
+        print(f"Using idle message prepared in advance: {speculation['text']}")
+
+        channel.lastIdleSpeaker = speculation["speaker"]
+        channel.lastIdleMessage = speculation["text"]
+
+        speakAudio(channel, speculation["pcm"], speculation["voice"])
+    else:
+        channel.lastIdleSpeaker = getNextIdleSpeaker(channel)
+        voice = getSpeakerVoice(channel, channel.lastIdleSpeaker)
+
+        messages = getIdleMessages(channel, channel.lastIdleSpeaker, channel.lastIdleMessage)
+
+        if flags.streamResponse:
+            spoken = speakResponse(channel, promptResponseStream(messages, channel), voice)
+        else:
+            spoken = speakResponse(channel, promptResponse(messages, channel), voice)
+
+        # if a unit broke in before anything was said, the next idle message replies to the same one
+        if len(spoken) > 0:
+            channel.lastIdleMessage = spoken
+
+    channel.lastIdleMessageTime  = time.time()
+    channel.nextIdleMessageDelay = random.randint(flags.idleIntervalMin, flags.idleIntervalMax)
+
+    print(f"[{channel.name}] Next idle message delay: {channel.nextIdleMessageDelay}s")
+    print("") # new line to prevent audio level from overwriting things
+
+    if not flags.dontSpeculateIdle:
+        speculateIdleMessage(channel)
+
+def replyWorker(channel):
+    waitForModels(channel)
+
+    while True:
+        kind, transcription, totalProcessStart = channel.replyQueue.get()
+
+        channel.replying.set()
+
+        try:
+            if kind == "idle":
+                respondToIdleMessage(channel)
+            elif kind == "error":
+                playError(channel)
+            else:
+                respondToTransmission(channel, transcription, totalProcessStart)
+        except Exception as e:
+            print(f"A {type(e).__name__} exception occurred while replying:", e)
+            metrics.increment("errors", stage = "reply", channel = channel.name)
+            playError(channel)
+        finally:
+            # in case an exception left us keyed up
+            channel.transmitting.clear()
+            channel.replying.clear()
+
+            if kind == "idle":
+                channel.idlePending.clear()
+
+# sleeps until an idle message is due, then hands it to the reply worker
+def idleTimer(channel):
+    while True:
+        # both of these only ever move later, so the soonest it could be due is worked out once and slept until
+        dueTime = max(channel.lastDetectionTime + flags.idleDelay, channel.lastIdleMessageTime + channel.nextIdleMessageDelay)
+
+        if time.time() < dueTime:
+            time.sleep(max(0, dueTime - time.time()))
+            continue
+
+        # don't start idle chatter while there's real traffic still being handled
+        busy = channel.receiving.is_set() or channel.idlePending.is_set() or channel.replying.is_set() or not transmissionQueue.empty() or not channel.replyQueue.empty()
+
+        if busy:
+            time.sleep(1)
+            continue
+
+        channel.idlePending.set()
+        channel.replyQueue.put(("idle", None, None))
+
+def createVoiceActivityDetector(sampleRate = flags.captureRate, chunkSize = MIC_STREAM_CHUNK_SIZE):
+    return VoiceActivityDetector(
+        sampleRate,
+        chunkSize,
+        minLevel = flags.threshold,
+        snr = flags.vadSnr,
+        maxFlatness = flags.vadMaxFlatness,
+        maxZeroCrossingRate = flags.vadMaxZeroCrossingRate,
+        hangoverSeconds = flags.padDuration
+    )
+
+def processLoop(channel):
+    print(f"[{channel.name}] Beginning process loop")
+
+    captureBuffer = CaptureBuffer(flags.captureRate, MIC_STREAM_CHUNK_SIZE, flags.maxDuration, flags.preRoll)
+    # the Recording of the current transmission
+    frames = None
+    recording = False
+    recordingStartTime = None
+    recordingOverlappedTransmit = False
+    # how many chunks of the recording were louder than our own audio, while we were transmitting, and the first of them
+    bargeInChunks = 0
+    bargeInStart = None
+    bargedIn = False
+    channel.lastDetectionTime = time.time()
+
+    lastLevelMeterTime = 0
+
+    transcriber = None
+    # the intent matched by the last partial transcript, so it's only matched again when the partial changes
+    lastPartial = None
+    lastPartialIntent = None
+
+    vad = createVoiceActivityDetector()
+
+    openMicrophoneStream(channel)
+
+    print(f"[{channel.name}] Started stream, beginning processing...")
+
+    try:
+        while True:
+            try:
+                currentTime, data = channel.chunkQueue.get(timeout = 1)
+            except queue.Empty:
+                # portaudio stops calling us if the device goes away
+                if not channel.micStream.is_active():
+                    raise Exception("The mic stream stopped unexpectedly.")
+                continue
+
+            transmissionEnded = False
+            failed = False
+
+            try:
+                timeSinceLastDetection = currentTime - channel.lastDetectionTime
+
+                # the chunk is copied into the pre-roll or the current recording once, and everything after this uses it in place
+                samples = captureBuffer.write(data)
+
+                speech, active = vad.update(samples)
+                level = vad.level
+
+                # redrawing the meter for every chunk is a lot of terminal output for no benefit
+                if currentTime - lastLevelMeterTime >= flags.levelMeterInterval:
+                    lastLevelMeterTime = currentTime
+                    clearPreviousLine()
+                    print(f"[{channel.name}] Audio level ({timeSinceLastDetection: .1f}s): {level}. {getPipelineStatus(channel)}")
+
+                # this chunk has speech in it,
+                # or the vad is still in its hangover (eg 2 seconds) after the last speech
+                if speech or (recording and active):
+                    if not recording:
+                        clearPreviousLine()
+                        print(f"[{channel.name}] Sound detected at level {level} (threshold is {vad.getThreshold():.0f}) starting recording...")
+                        print("") # new line to prevent audio level from overwriting things
+                        recordingStartTime = currentTime  # Initialize the start time
+
+                        # this chunk, and the pre-roll before it, are the start of the recording
+                        frames = captureBuffer.startRecording()
+
+                    recording = True
+
+                    # the end of what we played is still being heard for a moment after we unkey
+                    hearingOurselves = channel.transmitting.is_set() or channel.audioOutput.getLevel() > 0
+
+                    if recordingOverlappedTransmit and not hearingOurselves:
+                        # we've finished, so whatever comes next is someone answering us. it starts a transmission of its own,
+                        # rather than carrying on the one our own audio started (which would be dropped along with it)
+                        clearPreviousLine()
+                        print(f"[{channel.name}] Our transmission ended, ending the recording it started.")
+                        transmissionEnded = True
+                    elif hearingOurselves and not bargedIn:
+                        recordingOverlappedTransmit = True
+
+                        if flags.bargeIn:
+                            # our own audio is heard back through the mic, so only speech that's louder than what we're playing counts
+                            if speech and level > flags.bargeInEchoRatio * channel.audioOutput.getLevel():
+                                if bargeInChunks == 0:
+                                    bargeInStart = len(frames) - 1
+
+                                bargeInChunks += 1
+
+                            if bargeInChunks * MIC_STREAM_CHUNK_SIZE / flags.captureRate >= flags.bargeInMinDuration:
+                                clearPreviousLine()
+                                print(f"[{channel.name}] A unit is breaking in at level {level}, cutting our transmission off.")
+
+                                channel.bargeIn.set()
+                                channel.audioOutput.cancel()
+                                metrics.increment("bargeIns", channel = channel.name)
+
+                                # it's a unit rather than our own audio, so it's transcribed like any other transmission.
+                                # what was recorded before they started talking over us is our own audio, so their
+                                # transmission starts again from there
+                                recordingStartTime = currentTime - (len(frames) - 1 - bargeInStart) * MIC_STREAM_CHUNK_SIZE / flags.captureRate
+                                frames = captureBuffer.restartRecording(bargeInStart)
+
+                                if transcriber is not None:
+                                    transcriber.cancel()
+
+                                transcriber = None
+                                lastPartial = None
+                                lastPartialIntent = None
+                                # so it's started again below, like the start of any other transmission
+                                channel.receiving.clear()
+
+                                bargedIn = True
+                                recordingOverlappedTransmit = False
+
+                    # what's heard while we're transmitting is usually our own audio, so it only counts as traffic
+                    # (for the idle timer, and worth transcribing as it comes in) once a unit breaks in
+                    if not recordingOverlappedTransmit:
+                        if not channel.receiving.is_set():
+                            channel.receiving.set()
+                            discardIdleSpeculation(channel)
+
+                            if flags.streamingTranscription:
+                                transcriber = createStreamingTranscriber(frames)
+
+                        if speech:
+                            channel.lastDetectionTime = currentTime
+                        # if what's been said so far is already something we can respond to,
+                        # there's no need to wait for the whole hangover
+                        elif transcriber is not None and currentTime - channel.lastDetectionTime >= flags.earlyEndPadDuration:
+                            partial = transcriber.getPartial()
+
+                            if partial != lastPartial:
+                                lastPartial = partial
+                                lastPartialIntent, slots = intentRouter.match(partial)
+
+                            if lastPartialIntent is not None:
+                                clearPreviousLine()
+                                print(f"Partial transcription \"{partial}\" matched {lastPartialIntent}, ending recording early.")
+                                transmissionEnded = True
+
+                    # Check for max duration
+                    if currentTime - recordingStartTime >= flags.maxDuration or frames.isFull():
+                        clearPreviousLine()
+                        print("Max duration reached, stopping recording.")
+                        transmissionEnded = True
+
+                # no speech, and the hangover has run out
+                elif recording:
+                    transmissionEnded = True
+
+                if transmissionEnded:
+                    duration = currentTime - recordingStartTime
+
+                    if duration >= flags.minDuration:
+                        clearPreviousLine()
+                        print(f"[{channel.name}] Sound stopped at level {level} with duration of {duration: .2f} seconds")
+
+                        metrics.observe("capture", duration, channel = channel.name)
+
+                        # how long we waited after the last speech to decide the transmission was over.
+                        # our own audio doesn't move lastDetectionTime, so there's nothing to measure for it
+                        if not recordingOverlappedTransmit:
+                            metrics.observe("vadTrigger", currentTime - channel.lastDetectionTime, channel = channel.name)
+
+                        queueTransmission({
+                            "channel": channel,
+                            "frames": captureBuffer.stopRecording(),
+                            "duration": duration,
+                            "overlappedTransmit": recordingOverlappedTransmit,
+                            "totalProcessStart": currentTime,
+                            "transcriber": transcriber,
+                        })
                     else:
                         print(f"Sound stopped, discarding audio... Duration: {duration: .2f} seconds")
-                
+
+                        if transcriber is not None:
+                            transcriber.cancel()
+
+                        captureBuffer.discardRecording()
+            except Exception as e:
+                # only this transmission is lost, the stream keeps going
+                print(f"[{channel.name}] A {type(e).__name__} exception occurred while processing audio:", e)
+                metrics.increment("errors", stage = "capture", channel = channel.name)
+                failed = True
+
+                # unless it was already handed to the transcription worker
+                if captureBuffer.recording is not None:
+                    if transcriber is not None:
+                        transcriber.cancel()
+
+                    captureBuffer.discardRecording()
+
+            if transmissionEnded or failed:
                 # Reset recording states
-                frames = []
+                frames = None
                 recording = False
                 recordingStartTime = None
-                openMicrophoneStream()
+                recordingOverlappedTransmit = False
+                bargeInChunks = 0
+                bargeInStart = None
+                bargedIn = False
+                transcriber = None
+                lastPartial = None
+                lastPartialIntent = None
+                vad.hangover = 0
+                channel.receiving.clear()
                 print("Resetting recording state") # new line to prevent audio level from overwriting things
-            else: # if not recording, do idle messages
-                if flags.idleDelay > -1 and currentTime > lastDetectionTime + flags.idleDelay:
-                    if currentTime > lastIdleMessageTime + nextIdleMessageDelay:
-                        print(f"Responding to last idle message.")
-
-                        if lastIdleSpeaker is voice2:
-                            lastIdleSpeaker = dispatcherVoice
-                        else:
-                            lastIdleSpeaker = voice2
-
-                        messages = [
-                            {
-                                "role": "system",
-                                "content": prompt["primary"]
-                            },
-                            {
-                                "role": "system",
-                                "content": "Reply to the next message with this context: " + prompt["idle1"] if lastIdleSpeaker is dispatcherVoice else prompt["idle2"]
-                            },
-                            {
-                                "role": "user",
-                                "content": lastIdleMessage
-                            }
-                        ]
-
-                        lastIdleMessage = promptResponse(messages)
-
-                        speakResponse(lastIdleMessage, lastIdleSpeaker)
-
-                        lastIdleMessageTime  = time.time()
-                        nextIdleMessageDelay = random.randint(flags.idleIntervalMin, flags.idleIntervalMax)
-
-                        print(f"Next idle message delay: {nextIdleMessageDelay}s")
-                        print("") # new line to prevent audio level from overwriting things
+    finally:
+        channel.receiving.clear()
+        closeMicStream(channel)
+
+# keeps a channel listening, restarting its stream if anything goes wrong
+def listenLoop(channel):
+    while True:
+        try:
+            processLoop(channel)
+        except Exception as e:
+            print(f"A {type(e).__name__} exception occurred on line {e.__traceback__.__dict__}:", e)
+            print(f"[{channel.name}] The stream will be restarted.")
+            metrics.increment("restarts", channel = channel.name)
+            playError(channel)
+
+def createChannel(config):
+    with open(f"{promptsDirectory}/{config['prompt']}.txt", "r") as promptFile:
+        prompt = promptFile.read()
+        prompt = json.loads(prompt)
+
+    channel = Channel(
+        config["name"],
+        prompt,
+        config["piperVoice"],
+        config["idleVoice"],
+        inputDevice = config["inputDevice"],
+        outputDevice = config["outputDevice"],
+        maxQueuedChunks = flags.maxQueuedChunks
+    )
+
+    # all sounds and speech are played through this, sounds are decoded once at startup.
+    # the benchmark and batch transcription don't need to hear anything
+    if flags.benchmark is not None or flags.transcribeFiles is not None:
+        channel.audioOutput = NullAudioOutput()
+    else:
+        channel.audioOutput = timeStartup(f"audio output {channel.name}", AudioOutput, p, deviceIndex = channel.outputDevice)
+
+    if flags.delayNoise is not None and flags.delayNoise > 0:
+        channel.audioOutput.generateNoise(flags.delayNoise)
+
+    # message history for the llm, one thread per unit
+    channel.conversation = ConversationMemory(
+        prompt["primary"],
+        flags.contextTokens,
+        summarize = None if flags.dontSummarizeHistory else lambda summary, messages: summarizeConversation(channel, summary, messages)
+    )
+
+    channel.nextIdleMessageDelay = flags.idleIntervalMin
+
+    return channel
+
+channels = [createChannel(config) for config in channelConfigs]
+
+# every channel plays the same sounds, so they're only decoded once
+timeStartup("sounds", channels[0].audioOutput.loadSounds, soundsDirectory)
+
+for channel in channels[1:]:
+    channel.audioOutput.shareSounds(channels[0].audioOutput)
+
+# a TransmissionSegmenter that finds transmissions the same way processLoop does, in audio at sampleRate.
+# its chunks are as long as the mic's, so the pre-roll and the durations work out the same at any rate
+def createTransmissionSegmenter(sampleRate):
+    chunkSize = max(1, round(MIC_STREAM_CHUNK_SIZE * sampleRate / flags.captureRate))
+    chunkSeconds = chunkSize / sampleRate
+
+    return TransmissionSegmenter(
+        createVoiceActivityDetector(sampleRate, chunkSize),
+        # the chunk that starts a transmission is part of the pre-roll in processLoop
+        max(1, math.ceil(flags.preRoll / chunkSeconds)) - 1,
+        int(flags.maxDuration / chunkSeconds),
+        flags.minDuration / chunkSeconds
+    )
+
+# finds the transmissions in a whole recording at -captureRate.
+# returns (startChunk, endChunk, samples) for each one, where samples is what processLoop would have recorded (including the pre-roll)
+def findRecordingSegments(samples):
+    segmenter = createTransmissionSegmenter(flags.captureRate)
+
+    return segmenter.write(samples) + segmenter.finish()
+
+# replays recordings through the same vad, whisper, response and piper path as processLoop, timing each stage
+def runBenchmark():
+    channel = channels[0]
+
+    waitForModels(channel)
+    voice = voicePool.get(channel.voiceName)
+
+    # any format the archive writes can be replayed
+    files = sorted([f for f in os.listdir(flags.benchmark) if f.startswith("rx-") and f.endswith((".wav", ".flac", ".opus"))])
+
+    if len(files) == 0:
+        raise Exception(f"No recordings (rx-*.wav, .flac or .opus) to benchmark in {flags.benchmark}")
+
+    print(f"Benchmarking {len(files)} recordings...")
+
+    stages = {
+        "vad": [],
+        "asr": [],
+        "response": [],
+        "ttsFirstByte": [],
+        "tts": [],
+        "turnaround": [],
+    }
+
+    transmissions = []
+    audioSeconds = 0
+    transmissionSeconds = 0
+    chunkSeconds = MIC_STREAM_CHUNK_SIZE / flags.captureRate
+    benchmarkStartTime = time.time()
+
+    for file in files:
+        source = FileInputSource(os.path.join(flags.benchmark, file), flags.captureRate, padSeconds = flags.padDuration)
+        audioSeconds += source.getDuration()
+
+        startTime = time.time()
+        segments = findRecordingSegments(source.samples)
+        stages["vad"].append(time.time() - startTime)
+
+        for start, end, samples in segments:
+            duration = (end - start) * chunkSeconds
+            transmissionSeconds += duration
+
+            frames = Recording(samples, MIC_STREAM_CHUNK_SIZE, len(samples))
+
+            turnaroundStartTime = time.time()
+
+            startTime = time.time()
+            transcription = transcribeTransmission({ "channel": channel, "frames": frames })
+            stages["asr"].append(time.time() - startTime)
+
+            response = None
+
+            if len(transcription) > 0:
+                startTime = time.time()
+                intent, response = generateResponse(channel, transcription)
+
+                # a streamed response has to be read in full to be timed on its own
+                if response is not None and not isinstance(response, str):
+                    response = " ".join(response)
+
+                stages["response"].append(time.time() - startTime)
+
+            if response is not None:
+                startTime = time.time()
+                firstByteTime = None
+
+                for byteData in synthesizeSpeech(channel, response.replace("*", ""), voice):
+                    if firstByteTime is None:
+                        firstByteTime = time.time()
+                        stages["ttsFirstByte"].append(firstByteTime - startTime)
+
+                    channel.audioOutput.playPcm(byteData, voice.config.sample_rate, flags.voiceVolume)
+
+                stages["tts"].append(time.time() - startTime)
+
+            stages["turnaround"].append(time.time() - turnaroundStartTime)
+
+            transmissions.append({
+                "file": file,
+                "offset": start * chunkSeconds,
+                "duration": duration,
+                "transcription": transcription,
+                "response": response,
+            })
+
+    wallSeconds = time.time() - benchmarkStartTime
+
+    report = {
+        "settings": {
+            "asrBackend": getAsrEngine().name,
+            "asrModel": flags.asrModel,
+            "asrThreads": flags.asrThreads,
+            "asrProfile": flags.asrProfile,
+            "piperVoice": voice.modelName,
+            "voiceSpeed": flags.voiceSpeed,
+            "captureRate": flags.captureRate,
+            "chunkSize": MIC_STREAM_CHUNK_SIZE,
+            "ollamaModel": flags.ollamaModel if flags.benchmarkUseOllama else "stub",
+        },
+        "files": len(files),
+        "transmissions": len(transmissions),
+        "audioSeconds": audioSeconds,
+        "wallSeconds": wallSeconds,
+        # below 1 is faster than realtime
+        "realtimeFactor": wallSeconds / audioSeconds if audioSeconds > 0 else 0,
+        "asrRealtimeFactor": sum(stages["asr"]) / transmissionSeconds if transmissionSeconds > 0 else 0,
+        "peakRssMb": getPeakRss(),
+        "stages": { name: summarizeLatencies(values) for name, values in stages.items() },
+        "startup": startupTimings,
+        "results": transmissions,
+    }
+
+    if flags.benchmarkReport is not None:
+        with open(flags.benchmarkReport, "w") as reportFile:
+            json.dump(report, reportFile, indent = 4)
+
+        print(f"Benchmark report written to {flags.benchmarkReport}")
+    else:
+        print(json.dumps(report, indent = 4))
+
+if flags.benchmark is not None:
+    runBenchmark()
+
+    if not flags.benchmarkUseOllama:
+        stubOllama.close()
+
+    exit()
 
-while True:
+# waits for a transmission from runBatchTranscription to be transcribed (and replied to), and writes it out
+def finishBatchTranscription(channel, result, transcription, outputFile):
     try:
-        processLoop()
+        text, segments = transcription.get()
     except Exception as e:
-        print(f"A {type(e).__name__} exception occurred on line {e.__traceback__.__dict__}:", e)
-        print("The stream will be restarted.")
-        playError()
-    except KeyboardInterrupt:
-       print("KeyboardInterrupt quit")
-       closeMicStream()
-       exit()
\ No newline at end of file
+        print(f"A {type(e).__name__} exception occurred while transcribing {result['file']} at {result['offset']:.1f}s:", e)
+        result["error"] = str(e)
+        outputFile.write(json.dumps(result) + "\n")
+        return
+
+    result["transcription"] = text.strip(" .,\n").lower()
+    # from the start of the file, like offset
+    result["segments"] = [[result["offset"] + start, result["offset"] + end, segmentText.strip()] for start, end, segmentText in segments]
+
+    if flags.transcribeReplies and len(result["transcription"]) > 0:
+        intent, response = generateResponse(channel, result["transcription"])
+
+        # a streamed response is only wanted in full
+        if response is not None and not isinstance(response, str):
+            response = " ".join(response)
+
+        if response is not None and intent != "reset":
+            channel.conversation.addMessage(channel.lastUnit, "assistant", response)
+
+        result["intent"] = intent
+        result["response"] = response
+
+    outputFile.write(json.dumps(result) + "\n")
+
+# how much of a recording is read at once by runBatchTranscription
+TRANSCRIBE_BLOCK_SECONDS = 30
+
+# finds the transmissions in -transcribeFiles the same way processLoop would, transcribes them on the
+# transcription pool, and writes them to a json lines file in the order they were received
+def runBatchTranscription():
+    channel = channels[0]
+    paths = getRecordingPaths(flags.transcribeFiles)
+
+    if len(paths) == 0:
+        raise Exception(f"No recordings (.wav, .flac or .opus) to transcribe in {flags.transcribeFiles}")
+
+    if flags.transcribeOutput is not None:
+        outputPath = flags.transcribeOutput
+    elif os.path.isdir(flags.transcribeFiles):
+        outputPath = os.path.join(flags.transcribeFiles, "transcript.jsonl")
+    else:
+        outputPath = os.path.join(os.path.dirname(flags.transcribeFiles), "transcript.jsonl")
+
+    print(f"Transcribing {len(paths)} recordings to {outputPath}...")
+
+    # (result, transcription) for each transmission handed to the pool, oldest first.
+    # only a few are handed over at a time, so that hours of recordings aren't all waiting in memory
+    pending = collections.deque()
+    maxPending = transcribeProcesses * 2
+    transmissions = 0
+    audioSeconds = 0
+    startTime = time.time()
+
+    with open(outputPath, "w") as outputFile:
+        for path in paths:
+            fileSamples = 0
+            fileTransmissions = 0
+
+            try:
+                fileStartTime = getRecordingStartTime(path)
+
+                # the file is read and searched a block at a time, at its own rate if it's a wav,
+                # or at the rate whisper wants if it has to be decoded, so nothing is resampled twice
+                sampleRate, blocks = readPcmBlocks(path, TRANSCRIBE_BLOCK_SECONDS, ASR_SAMPLE_RATE)
+                segmenter = createTransmissionSegmenter(sampleRate)
+
+                # the last block is None, which ends the transmission that's still going at the end of the file
+                for block in itertools.chain(blocks, [None]):
+                    if block is None:
+                        segments = segmenter.finish()
+                    else:
+                        fileSamples += len(block)
+                        segments = segmenter.write(block)
+
+                    for start, end, samples in segments:
+                        # where the samples (including the pre-roll) start in the file
+                        offset = (end * segmenter.chunkSize - len(samples)) / sampleRate
+
+                        result = {
+                            "file": os.path.basename(path),
+                            "offset": offset,
+                            "duration": len(samples) / sampleRate,
+                            "time": (fileStartTime + datetime.timedelta(seconds = offset)).isoformat(timespec = "milliseconds"),
+                        }
+
+                        pending.append((result, transcriptionPool.apply_async(transcribeSegment, (samples, sampleRate, getVocabularyPrompt()))))
+                        transmissions += 1
+                        fileTransmissions += 1
+
+                        while len(pending) > maxPending:
+                            finishBatchTranscription(channel, *pending.popleft(), outputFile)
+            except Exception as e:
+                print(f"A {type(e).__name__} exception occurred while transcribing {path}:", e)
+                continue
+
+            fileSeconds = fileSamples / sampleRate
+            audioSeconds += fileSeconds
+
+            print(f"{os.path.basename(path)}: {fileTransmissions} transmissions in {fileSeconds:.1f}s")
+
+        while len(pending) > 0:
+            finishBatchTranscription(channel, *pending.popleft(), outputFile)
+
+    transcriptionPool.close()
+    transcriptionPool.join()
+
+    wallSeconds = time.time() - startTime
+
+    # below 1 is faster than realtime
+    print(f"Transcribed {transmissions} transmissions from {audioSeconds:.1f}s of audio in {wallSeconds:.1f}s (realtime factor {wallSeconds / audioSeconds if audioSeconds > 0 else 0:.3f})")
+
+if flags.transcribeFiles is not None:
+    runBatchTranscription()
+    exit()
+
+def startWorkers():
+    threading.Thread(target = transcriptionWorker, name = "transcription", daemon = True).start()
+
+    for channel in channels:
+        threading.Thread(target = replyWorker, args = (channel,), name = f"reply-{channel.name}", daemon = True).start()
+        threading.Thread(target = listenLoop, args = (channel,), name = f"listen-{channel.name}", daemon = True).start()
+
+        if flags.idleDelay > -1:
+            threading.Thread(target = idleTimer, args = (channel,), name = f"idle-{channel.name}", daemon = True).start()
+
+startWorkers()
+
+threading.Thread(target = reportStartup, name = "startupReport", daemon = True).start()
+
+if not flags.dontWarmUpOllama:
+    ollama.warmUpInBackground()
+
+if flags.prewarmSpeechCache and speechCache is not None:
+    threading.Thread(target = prewarmSpeechCache, name = "prewarm", daemon = True).start()
+
+# everything runs on the channels' threads, this one just waits to be interrupted
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+   print("KeyboardInterrupt quit")
+   exit()
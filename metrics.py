@@ -0,0 +1,149 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+# collects timings (spans) and counters from every stage of the pipeline.
+#
+# every span is appended to a json lines file (if jsonLinesPath is given) by a background thread,
+# and a prometheus text file (if prometheusPath is given) is rewritten every interval seconds,
+# so nothing here does file io on the thread that records the metric.
+class Metrics:
+    def __init__(self, jsonLinesPath = None, prometheusPath = None, interval = 15, prefix = "dispatcher", keepValues = 1000):
+        self.jsonLinesPath = jsonLinesPath
+        self.prometheusPath = prometheusPath
+        self.interval = interval
+        self.prefix = prefix
+        self.keepValues = keepValues
+
+        # name -> { "count": int, "sum": float, "values": deque of the most recent values }
+        self.spans = {}
+        # name -> int
+        self.counters = collections.defaultdict(int)
+        # name -> float
+        self.gauges = {}
+
+        self.lock = threading.Lock()
+        self.events = queue.Queue()
+
+        if self.jsonLinesPath is not None or self.prometheusPath is not None:
+            threading.Thread(target = self._writeLoop, name = "metrics", daemon = True).start()
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            if name not in self.spans:
+                self.spans[name] = {
+                    "count": 0,
+                    "sum": 0,
+                    "values": collections.deque(maxlen = self.keepValues),
+                }
+
+            span = self.spans[name]
+            span["count"] += 1
+            span["sum"] += seconds
+            span["values"].append(seconds)
+
+        self._logEvent({ "type": "span", "name": name, "seconds": round(seconds, 4), **labels })
+
+    def increment(self, name, amount = 1, **labels):
+        with self.lock:
+            self.counters[name] += amount
+
+        self._logEvent({ "type": "counter", "name": name, "amount": amount, **labels })
+
+    def setGauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def getCounter(self, name):
+        with self.lock:
+            return self.counters[name]
+
+    def _logEvent(self, event):
+        if self.jsonLinesPath is not None:
+            event["time"] = time.time()
+            self.events.put(event)
+
+    @staticmethod
+    def _quantile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def getSummary(self):
+        with self.lock:
+            return {
+                "spans": {
+                    name: {
+                        "count": span["count"],
+                        "sum": span["sum"],
+                        "p50": self._quantile(span["values"], 0.5),
+                        "p95": self._quantile(span["values"], 0.95),
+                        "max": max(span["values"]),
+                    } for name, span in self.spans.items()
+                },
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def getPrometheusText(self):
+        summary = self.getSummary()
+        lines = []
+
+        for name, span in summary["spans"].items():
+            metric = f"{self.prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            lines.append(f"{metric}{{quantile=\"0.5\"}} {span['p50']}")
+            lines.append(f"{metric}{{quantile=\"0.95\"}} {span['p95']}")
+            lines.append(f"{metric}_sum {span['sum']}")
+            lines.append(f"{metric}_count {span['count']}")
+
+        for name, value in summary["counters"].items():
+            metric = f"{self.prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+
+        for name, value in summary["gauges"].items():
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def writePrometheusFile(self):
+        # written to a temporary file first so that a scraper never reads half a file
+        temporaryPath = f"{self.prometheusPath}.tmp"
+
+        with open(temporaryPath, "w") as prometheusFile:
+            prometheusFile.write(self.getPrometheusText())
+
+        os.replace(temporaryPath, self.prometheusPath)
+
+    def _writeLoop(self):
+        jsonLinesFile = open(self.jsonLinesPath, "a") if self.jsonLinesPath is not None else None
+        lastPrometheusWrite = 0
+
+        while True:
+            try:
+                event = self.events.get(timeout = 1)
+
+                jsonLinesFile.write(json.dumps(event) + "\n")
+
+                # write everything that's waiting before flushing
+                while not self.events.empty():
+                    jsonLinesFile.write(json.dumps(self.events.get_nowait()) + "\n")
+
+                jsonLinesFile.flush()
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"A {type(e).__name__} exception occurred while writing metrics:", e)
+
+            if self.prometheusPath is not None and time.time() - lastPrometheusWrite >= self.interval:
+                lastPrometheusWrite = time.time()
+
+                try:
+                    self.writePrometheusFile()
+                except Exception as e:
+                    print(f"A {type(e).__name__} exception occurred while writing metrics:", e)
@@ -0,0 +1,145 @@
+import json
+import requests
+import requests.adapters
+import threading
+import time
+
+# talks to ollama over one pooled session, so that each prompt reuses an open connection
+# instead of making a new one. keepAlive is passed with every request so that ollama keeps the
+# model loaded between sparse radio calls.
+class OllamaClient:
+    def __init__(self, uri, model, keepAlive = "30m", connectTimeout = 5, readTimeout = 120, retries = 2, backoff = 0.5, debug = False):
+        self.uri = uri
+        self.model = model
+        self.keepAlive = keepAlive
+        self.timeout = (connectTimeout, readTimeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.debug = debug
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = 4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _post(self, path, body, stream = False):
+        body = {
+            "model": self.model,
+            "keep_alive": self.keepAlive,
+            **body
+        }
+
+        attempt = 0
+
+        while True:
+            try:
+                request = self.session.post(f"{self.uri}{path}", json = body, stream = stream, timeout = self.timeout)
+
+                # ollama returns 5xx while a model is failing to load, worth trying again
+                if request.status_code >= 500 and attempt < self.retries:
+                    request.close()
+                    raise requests.exceptions.RetryError(f"ollama returned {request.status_code}")
+
+                return request
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.RetryError) as e:
+                if attempt >= self.retries:
+                    raise
+
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+
+                print(f"Request to ollama failed ({type(e).__name__}), retrying in {delay}s ({attempt}/{self.retries})...")
+                time.sleep(delay)
+
+    @staticmethod
+    def _checkResponse(response):
+        if response.get("error") is not None:
+            raise Exception("Error response from model: " + response.get("error"))
+
+    # ollama reports durations in nanoseconds
+    @staticmethod
+    def getTimings(response):
+        seconds = lambda key: response.get(key, 0) / 1e9
+
+        return {
+            "total": seconds("total_duration"),
+            "load": seconds("load_duration"),
+            "promptEval": seconds("prompt_eval_duration"),
+            "promptTokens": response.get("prompt_eval_count", 0),
+            "eval": seconds("eval_duration"),
+            "evalTokens": response.get("eval_count", 0),
+        }
+
+    @staticmethod
+    def printTimings(timings):
+        tokensPerSecond = timings["evalTokens"] / timings["eval"] if timings["eval"] > 0 else 0
+
+        print(f"Model load took {timings['load']:.2f}s, prompt eval {timings['promptEval']:.2f}s ({timings['promptTokens']} tokens), eval {timings['eval']:.2f}s ({timings['evalTokens']} tokens, {tokensPerSecond:.1f}/s).")
+
+    # returns the content of the response message
+    def chat(self, messages):
+        request = self._post("/api/chat", {
+            "messages": messages,
+            "stream": False,
+        })
+
+        if self.debug:
+            print("Raw response content: ", request.content)
+
+        response = request.json()
+
+        self._checkResponse(response)
+
+        if response.get("message") is None:
+            raise Exception("Message from model was None.")
+
+        self.printTimings(self.getTimings(response))
+
+        return response.get("message")["content"]
+
+    # yields the response a token at a time
+    def chatStream(self, messages):
+        request = self._post("/api/chat", {
+            "messages": messages,
+            "stream": True,
+        }, stream = True)
+
+        with request:
+            # ollama sends one json object per line (ndjson)
+            for line in request.iter_lines():
+                if not line:
+                    continue
+
+                if self.debug:
+                    print("Raw response line: ", line)
+
+                chunk = json.loads(line)
+
+                self._checkResponse(chunk)
+
+                if chunk.get("message") is not None:
+                    yield chunk.get("message")["content"]
+
+                # the last chunk has the timings in it
+                if chunk.get("done"):
+                    self.printTimings(self.getTimings(chunk))
+                    break
+
+    # a chat request with no messages just loads the model, so that the first real prompt doesn't have to wait for it
+    def warmUp(self):
+        startTime = time.time()
+
+        try:
+            response = self._post("/api/chat", {
+                "messages": [],
+                "stream": False,
+            }).json()
+
+            self._checkResponse(response)
+
+            print(f"Ollama model {self.model} warmed up in {time.time() - startTime:.2f}s (load took {self.getTimings(response)['load']:.2f}s).")
+        except Exception as e:
+            print(f"A {type(e).__name__} exception occurred while warming up ollama:", e)
+
+    def warmUpInBackground(self):
+        threading.Thread(target = self.warmUp, name = "ollamaWarmUp", daemon = True).start()
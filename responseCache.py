@@ -0,0 +1,99 @@
+import collections
+import hashlib
+import random
+import re
+import threading
+import time
+
+# caches the llm's responses to traffic it has already answered, so that things like radio checks don't go to ollama every time.
+#
+# a response is looked up by the system messages (the channel's prompt, and the summary of a long conversation),
+# what was just said, and what we said last, so the same words only get the same answer in the same situation.
+# entries expire after maxAgeSeconds, and the least recently used are evicted once there are more than maxEntries.
+#
+# with more than one variant, the model is asked again until it has given that many different responses,
+# and after that one of them is picked at random (but not the one that was used last time).
+class ResponseCache:
+    def __init__(self, maxEntries, maxAgeSeconds = 0, variants = 1):
+        self.maxEntries = maxEntries
+        # 0 means they don't expire
+        self.maxAgeSeconds = maxAgeSeconds
+        self.variants = variants
+
+        # key -> { "created": time, "responses": [...], "last": index of the response used last }, least recently used first
+        self.entries = collections.OrderedDict()
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalizeText(text):
+        # punctuation and case depend on whisper's mood rather than what was said. dashes are kept for codes like 10-4
+        return re.sub(r"\s+", " ", re.sub(r"[^\w\s-]", "", text.lower())).strip()
+
+    @staticmethod
+    def getKey(messages):
+        profile = "\n".join(message["content"] for message in messages if message["role"] == "system")
+        said = ResponseCache.normalizeText(messages[-1]["content"])
+
+        # the last thing we said, if anything
+        replies = [message["content"] for message in messages[:-1] if message["role"] == "assistant"]
+        context = ResponseCache.normalizeText(replies[-1]) if len(replies) > 0 else ""
+
+        key = f"{profile}|{said}|{context}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    # returns a cached response to messages, or None if the model should be asked
+    def get(self, messages):
+        key = self.getKey(messages)
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and self.maxAgeSeconds > 0 and time.time() - entry["created"] > self.maxAgeSeconds:
+                del self.entries[key]
+                entry = None
+
+            if entry is None or len(entry["responses"]) < self.variants:
+                self.stats["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+
+            choices = [i for i in range(len(entry["responses"])) if i != entry["last"]] or [entry["last"]]
+            entry["last"] = random.choice(choices)
+
+            return entry["responses"][entry["last"]]
+
+    def put(self, messages, response):
+        key = self.getKey(messages)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = { "created": time.time(), "responses": [], "last": None }
+
+            entry = self.entries[key]
+            self.entries.move_to_end(key)
+
+            # the model can give the same response twice, it's only one variant
+            if response in entry["responses"]:
+                entry["last"] = entry["responses"].index(response)
+            elif len(entry["responses"]) < self.variants:
+                entry["responses"].append(response)
+                entry["last"] = len(entry["responses"]) - 1
+
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last = False)
+
+    def getHitRate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+
+        return self.stats["hits"] / total if total > 0 else 0
+
+    def getStatus(self):
+        return f"Response cache: {self.stats['hits']} hits, {self.stats['misses']} misses ({self.getHitRate() * 100:.0f}% hit rate). {len(self.entries)} entries."
@@ -0,0 +1,78 @@
+import collections
+import threading
+
+# shares something that can only do a few things at once (eg. ollama, or the cpu for synthesis) between channels.
+#
+# waiters are served round robin by channel rather than first come first served,
+# so a busy channel can't starve a quiet one: once a channel has had a turn,
+# every other channel that is waiting goes before its next turn.
+# threads waiting on the same channel are served in the order they asked.
+#
+# with scheduler.use(channel):
+#     ...
+class FairScheduler:
+    def __init__(self, name, slots = 1):
+        self.name = name
+        self.slots = slots
+        self.inUse = 0
+
+        # channel -> deque of events, one for each thread waiting on that channel
+        self.waiting = {}
+        # every channel that has asked for a turn, in the order they're served
+        self.rotation = []
+        self.lastServed = None
+        self.condition = threading.Condition()
+
+    def acquire(self, channel):
+        with self.condition:
+            if channel not in self.rotation:
+                self.rotation.append(channel)
+
+            if self.inUse < self.slots and len(self.waiting) == 0:
+                self.inUse += 1
+                self.lastServed = channel
+                return
+
+            ticket = threading.Event()
+            self.waiting.setdefault(channel, collections.deque()).append(ticket)
+
+            while not ticket.is_set():
+                self.condition.wait()
+
+    def release(self):
+        with self.condition:
+            if len(self.waiting) == 0:
+                self.inUse -= 1
+                return
+
+            # the slot goes straight to the next waiting channel after the one that was served last
+            start = self.rotation.index(self.lastServed) + 1 if self.lastServed in self.rotation else 0
+            channel = next(channel for channel in self.rotation[start:] + self.rotation[:start] if channel in self.waiting)
+
+            tickets = self.waiting[channel]
+            tickets.popleft().set()
+
+            if len(tickets) == 0:
+                del self.waiting[channel]
+
+            self.lastServed = channel
+            self.condition.notify_all()
+
+    def use(self, channel):
+        return _Turn(self, channel)
+
+    def getWaitingCount(self):
+        with self.condition:
+            return sum(len(tickets) for tickets in self.waiting.values())
+
+class _Turn:
+    def __init__(self, scheduler, channel):
+        self.scheduler = scheduler
+        self.channel = channel
+
+    def __enter__(self):
+        self.scheduler.acquire(self.channel)
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        self.scheduler.release()
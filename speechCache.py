@@ -0,0 +1,143 @@
+import collections
+import hashlib
+import os
+import re
+import threading
+
+# caches synthesised speech so that canned and repeated responses don't have to go through piper again.
+# there's a small in-memory tier in front of a larger on-disk tier, both evicted least recently used first.
+class SpeechCache:
+    def __init__(self, directory, maxMemoryBytes, maxDiskBytes):
+        self.directory = directory
+        self.maxMemoryBytes = maxMemoryBytes
+        self.maxDiskBytes = maxDiskBytes
+
+        # key -> (sampleRate, pcm)
+        self.memory = collections.OrderedDict()
+        self.memoryBytes = 0
+
+        # key -> size in bytes, oldest first
+        self.disk = collections.OrderedDict()
+        self.diskBytes = 0
+
+        self.stats = {
+            "memoryHits": 0,
+            "diskHits": 0,
+            "misses": 0,
+        }
+
+        self.lock = threading.Lock()
+
+        if self.maxDiskBytes > 0:
+            os.makedirs(self.directory, exist_ok = True)
+            self._scanDisk()
+
+    def _scanDisk(self):
+        files = []
+
+        for file in os.listdir(self.directory):
+            if file.endswith(".pcm"):
+                path = os.path.join(self.directory, file)
+                files.append((os.path.getmtime(path), file[:-4], os.path.getsize(path)))
+
+        # least recently used first
+        for mtime, key, size in sorted(files):
+            self.disk[key] = size
+            self.diskBytes += size
+
+        self._pruneDisk()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pcm")
+
+    def _pruneMemory(self):
+        while self.memoryBytes > self.maxMemoryBytes and len(self.memory) > 0:
+            key, (sampleRate, pcm) = self.memory.popitem(last = False)
+            self.memoryBytes -= len(pcm)
+
+    def _pruneDisk(self):
+        while self.diskBytes > self.maxDiskBytes and len(self.disk) > 0:
+            key, size = self.disk.popitem(last = False)
+            self.diskBytes -= size
+
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def normalizeText(text):
+        return re.sub(r"\s+", " ", text.replace("*", "")).strip().lower()
+
+    @staticmethod
+    def getKey(voiceName, lengthScale, text):
+        key = f"{voiceName}|{lengthScale:.3f}|{SpeechCache.normalizeText(text)}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    # returns (sampleRate, pcm) or None
+    def get(self, voiceName, lengthScale, text):
+        key = self.getKey(voiceName, lengthScale, text)
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memoryHits"] += 1
+                return self.memory[key]
+
+            if key in self.disk:
+                try:
+                    with open(self._path(key), "rb") as file:
+                        data = file.read()
+                except FileNotFoundError:
+                    self.diskBytes -= self.disk.pop(key)
+                else:
+                    # the file starts with the sample rate, followed by the pcm
+                    entry = (int.from_bytes(data[:4], "little"), data[4:])
+
+                    self.disk.move_to_end(key)
+                    os.utime(self._path(key))
+
+                    self._putMemory(key, entry)
+                    self.stats["diskHits"] += 1
+                    return entry
+
+            self.stats["misses"] += 1
+            return None
+
+    def _putMemory(self, key, entry):
+        if key in self.memory:
+            self.memoryBytes -= len(self.memory[key][1])
+
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        self.memoryBytes += len(entry[1])
+        self._pruneMemory()
+
+    def put(self, voiceName, lengthScale, text, sampleRate, pcm):
+        key = self.getKey(voiceName, lengthScale, text)
+        entry = (sampleRate, pcm)
+
+        with self.lock:
+            self._putMemory(key, entry)
+
+            if self.maxDiskBytes > 0:
+                with open(self._path(key), "wb") as file:
+                    file.write(sampleRate.to_bytes(4, "little"))
+                    file.write(pcm)
+
+                if key in self.disk:
+                    self.diskBytes -= self.disk[key]
+
+                self.disk[key] = len(pcm) + 4
+                self.disk.move_to_end(key)
+                self.diskBytes += len(pcm) + 4
+                self._pruneDisk()
+
+    def getHitRate(self):
+        hits = self.stats["memoryHits"] + self.stats["diskHits"]
+        total = hits + self.stats["misses"]
+
+        return hits / total if total > 0 else 0
+
+    def getStatus(self):
+        return f"Speech cache: {self.stats['memoryHits']} memory hits, {self.stats['diskHits']} disk hits, {self.stats['misses']} misses ({self.getHitRate() * 100:.0f}% hit rate). {len(self.memory)} in memory ({self.memoryBytes / 1048576:.1f}MB), {len(self.disk)} on disk ({self.diskBytes / 1048576:.1f}MB)."
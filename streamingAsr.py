@@ -0,0 +1,115 @@
+import re
+import threading
+import time
+
+# transcribes a transmission while it's still being received.
+#
+# every stepSeconds the audio since the last commit is transcribed again. segments that come back
+# the same in two passes in a row (apart from the last one, which is usually still being spoken)
+# are committed, and the audio they cover is never decoded again. when the transmission ends,
+# only the audio after the last commit still has to be transcribed.
+#
+# frames is the transmission's Recording (or a list of raw chunks), which the caller keeps writing to.
+# transcribe(audio, prompt) returns a list of (start, end, text) segments for the audio.
+# toAudio(frames[i:j]) converts the chunks into whatever transcribe takes.
+class StreamingTranscriber:
+    def __init__(self, frames, transcribe, toAudio, sampleRate, chunkSize, stepSeconds = 1, windowSeconds = 10, minSeconds = 1):
+        self.frames = frames
+        self.transcribe = transcribe
+        self.toAudio = toAudio
+        self.chunkSeconds = chunkSize / sampleRate
+        self.stepSeconds = stepSeconds
+        self.windowSeconds = windowSeconds
+        self.minSeconds = minSeconds
+
+        # index of the first chunk that hasn't been committed yet
+        self.committedChunk = 0
+        self.committedText = []
+        self.previousSegments = None
+        self.hypothesis = ""
+
+        self.passes = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target = self._loop, name = "streamingAsr", daemon = True)
+        self.thread.start()
+
+    @staticmethod
+    def _normalize(text):
+        return re.sub(r"[^a-z0-9' ]+", "", text.lower()).strip()
+
+    def _getPrompt(self):
+        # what's already been said helps whisper with the rest of it
+        return " ".join(self.committedText) if len(self.committedText) > 0 else None
+
+    def _loop(self):
+        while not self.stopped.wait(self.stepSeconds):
+            try:
+                self._step()
+            except Exception as e:
+                print(f"A {type(e).__name__} exception occurred during streaming transcription:", e)
+
+    def _step(self):
+        startChunk = self.committedChunk
+        endChunk = len(self.frames)
+        duration = (endChunk - startChunk) * self.chunkSeconds
+
+        if duration < self.minSeconds:
+            return
+
+        segments = self.transcribe(self.toAudio(self.frames[startChunk:endChunk]), self._getPrompt())
+        self.passes += 1
+
+        if self.stopped.is_set():
+            return
+
+        # local agreement: commit the segments that match the previous pass
+        stable = 0
+        if self.previousSegments is not None:
+            for segment, previous in zip(segments[:-1], self.previousSegments):
+                if self._normalize(segment[2]) != self._normalize(previous[2]):
+                    break
+                stable += 1
+
+        # the window is getting long, commit everything but the last segment rather than keep decoding it
+        if stable == 0 and duration >= self.windowSeconds:
+            stable = len(segments) - 1
+
+        with self.lock:
+            if stable > 0:
+                for segment in segments[:stable]:
+                    self.committedText.append(segment[2].strip())
+
+                self.committedChunk = startChunk + int(segments[stable - 1][1] / self.chunkSeconds)
+                # timestamps were relative to the old start, so they can't be compared any more
+                self.previousSegments = None
+            else:
+                self.previousSegments = segments
+
+            self.hypothesis = " ".join(segment[2].strip() for segment in segments[stable:])
+
+    # committed text followed by the latest guess at the rest
+    def getPartial(self):
+        with self.lock:
+            return " ".join(self.committedText + [self.hypothesis]).strip()
+
+    def cancel(self):
+        self.stopped.set()
+
+    # stops transcribing in the background, transcribes whatever hasn't been committed yet and returns the full text
+    def finish(self):
+        self.stopped.set()
+        self.thread.join()
+
+        startTime = time.time()
+        remainingChunks = len(self.frames) - self.committedChunk
+        text = list(self.committedText)
+
+        if remainingChunks > 0:
+            for segment in self.transcribe(self.toAudio(self.frames[self.committedChunk:]), self._getPrompt()):
+                text.append(segment[2].strip())
+
+        print(f"Streaming transcription: {len(self.committedText)} segments committed over {self.passes} passes, {remainingChunks * self.chunkSeconds:.1f}s left to transcribe took {time.time() - startTime:.1f}s")
+
+        return " ".join(text)
@@ -0,0 +1,103 @@
+import numpy
+
+# works out whether chunks of int16 audio contain a transmission.
+#
+# a chunk is speech when its energy is above both the minimum level and the adaptive noise floor
+# (multiplied by snr), and it doesn't look like noise. white noise, like an open squelch or a
+# squelch tail, has a flat spectrum and crosses zero much more often than speech does.
+#
+# once speech stops, the detector stays active for hangoverSeconds so that pauses between words
+# don't end the transmission.
+class VoiceActivityDetector:
+    def __init__(self, sampleRate, chunkSize, minLevel = 500, snr = 3.0, maxFlatness = 0.45, maxZeroCrossingRate = 0.4, hangoverSeconds = 2, noiseFloorRise = 0.05, noiseFloorFall = 0.5):
+        self.sampleRate = sampleRate
+        self.chunkSize = chunkSize
+        self.minLevel = minLevel
+        self.snr = snr
+        self.maxFlatness = maxFlatness
+        self.maxZeroCrossingRate = maxZeroCrossingRate
+        self.hangoverChunks = int(numpy.ceil(hangoverSeconds * sampleRate / chunkSize))
+        # how quickly the noise floor follows the level up and down
+        self.noiseFloorRise = noiseFloorRise
+        self.noiseFloorFall = noiseFloorFall
+
+        self.reset()
+
+    def reset(self):
+        self.noiseFloor = None
+        self.hangover = 0
+        # level of the last chunk, same scale as audioop.rms
+        self.level = 0
+
+    def getThreshold(self):
+        if self.noiseFloor is None:
+            return self.minLevel
+
+        return max(self.minLevel, self.noiseFloor * self.snr)
+
+    # features for a 2d array of chunks, one chunk per row.
+    # returns (level, zeroCrossingRate, flatness), each with one value per chunk
+    @staticmethod
+    def getFeatures(chunks):
+        samples = chunks.astype(numpy.float32)
+
+        level = numpy.sqrt(numpy.mean(samples * samples, axis = 1))
+
+        signs = numpy.signbit(samples)
+        zeroCrossingRate = numpy.mean(signs[:, 1:] != signs[:, :-1], axis = 1)
+
+        # spectral flatness is the geometric mean of the power spectrum over its arithmetic mean.
+        # 1 for white noise, close to 0 for tonal sounds like voices.
+        power = numpy.abs(numpy.fft.rfft(samples * numpy.hanning(samples.shape[1]), axis = 1)) ** 2 + 1e-10
+        flatness = numpy.exp(numpy.mean(numpy.log(power), axis = 1)) / numpy.mean(power, axis = 1)
+
+        return level, zeroCrossingRate, flatness
+
+    def _decide(self, level, zeroCrossingRate, flatness):
+        speech = level > self.getThreshold() and flatness < self.maxFlatness and zeroCrossingRate < self.maxZeroCrossingRate
+
+        if speech:
+            self.hangover = self.hangoverChunks
+        else:
+            # only follow the level while nobody is talking, so speech doesn't raise the floor
+            if self.noiseFloor is None:
+                self.noiseFloor = level
+            else:
+                rate = self.noiseFloorRise if level > self.noiseFloor else self.noiseFloorFall
+                self.noiseFloor += rate * (level - self.noiseFloor)
+
+            if self.hangover > 0:
+                self.hangover -= 1
+
+        self.level = int(level)
+
+        return speech, speech or self.hangover > 0
+
+    # data is the raw bytes of one chunk from the mic, or an int16 array.
+    # returns (speech, active). speech is whether this chunk contains speech,
+    # active is whether we're still inside a transmission (including the hangover after speech)
+    def update(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = numpy.frombuffer(data, dtype = numpy.int16)
+
+        level, zeroCrossingRate, flatness = self.getFeatures(data.reshape(1, -1))
+
+        return self._decide(level[0], zeroCrossingRate[0], flatness[0])
+
+    # evaluates a whole int16 buffer at once, eg. a recording.
+    # the buffer is split into chunks and the features for all of them are worked out in one go.
+    # returns (speech, active, level) arrays with one value per chunk
+    def evaluate(self, samples):
+        chunkCount = len(samples) // self.chunkSize
+        chunks = samples[:chunkCount * self.chunkSize].reshape(chunkCount, self.chunkSize)
+
+        levels, zeroCrossingRates, flatnesses = self.getFeatures(chunks)
+
+        speech = numpy.zeros(chunkCount, dtype = bool)
+        active = numpy.zeros(chunkCount, dtype = bool)
+
+        # the noise floor depends on previous decisions, so this part can't be vectorised
+        for i in range(chunkCount):
+            speech[i], active[i] = self._decide(levels[i], zeroCrossingRates[i], flatnesses[i])
+
+        return speech, active, levels
@@ -0,0 +1,113 @@
+import collections
+import json
+import os
+import random
+import threading
+
+# loads piper voices from a directory when they're first asked for, and keeps them loaded
+# until they've used more than maxBytes between them, unloading the least recently used first.
+#
+# every voice's onnxruntime session is created with the same options (set once here), rather than piper's defaults.
+# each session still has a thread pool of its own, so threads should be the voice's share of the cores,
+# otherwise every loaded voice starts a thread pool the size of the machine.
+class VoicePool:
+    def __init__(self, directory, maxBytes, lengthScale = 1, threads = 1):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lengthScale = lengthScale
+        self.threads = threads
+
+        # name -> (voice, size in bytes), least recently used first
+        self.voices = collections.OrderedDict()
+        self.loadedBytes = 0
+
+        # name -> lock, so that a voice being loaded by one thread isn't loaded again by another
+        self.loading = {}
+
+        self.sessionOptions = None
+        self.lock = threading.Lock()
+
+    # names of every voice in the directory, without the extension
+    def getVoiceNames(self):
+        return sorted([f.removesuffix(".onnx") for f in os.listdir(self.directory) if not f.startswith(".") and f.endswith(".onnx")])
+
+    def getRandomVoiceName(self, exclude = None):
+        names = [name for name in self.getVoiceNames() if name != exclude]
+
+        if len(names) == 0:
+            raise Exception(f"There are no voices in {self.directory}")
+
+        return random.choice(names)
+
+    def _getSessionOptions(self):
+        import onnxruntime
+
+        if self.sessionOptions is None:
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            options.intra_op_num_threads = self.threads
+            options.inter_op_num_threads = 1
+            self.sessionOptions = options
+
+        return self.sessionOptions
+
+    def _load(self, name):
+        import onnxruntime
+        from piper.config import PiperConfig
+        from piper.voice import PiperVoice
+
+        print(f"Loading voice: {name}")
+
+        path = os.path.join(self.directory, f"{name}.onnx")
+
+        with open(f"{path}.json", "r") as configFile:
+            config = PiperConfig.from_dict(json.load(configFile))
+
+        # the same as PiperVoice.load, apart from the session options
+        voice = PiperVoice(
+            config = config,
+            session = onnxruntime.InferenceSession(path, sess_options = self._getSessionOptions(), providers = ["CPUExecutionProvider"])
+        )
+
+        # used to tell voices apart in the speech cache
+        voice.modelName = name
+        voice.config.length_scale = self.lengthScale
+
+        # the weights make up nearly all of a voice's memory
+        return voice, os.path.getsize(path)
+
+    # returns the voice, loading it if it isn't already
+    def get(self, name):
+        with self.lock:
+            if name in self.voices:
+                self.voices.move_to_end(name)
+                return self.voices[name][0]
+
+            loadingLock = self.loading.setdefault(name, threading.Lock())
+
+        with loadingLock:
+            # another thread might have loaded it while we were waiting
+            with self.lock:
+                if name in self.voices:
+                    self.voices.move_to_end(name)
+                    return self.voices[name][0]
+
+            voice, size = self._load(name)
+
+            with self.lock:
+                self.voices[name] = (voice, size)
+                self.loadedBytes += size
+                self.loading.pop(name, None)
+
+                self._evict()
+
+        return voice
+
+    def _evict(self):
+        # the voice that was just asked for is never unloaded
+        while self.loadedBytes > self.maxBytes and len(self.voices) > 1:
+            name, (voice, size) = self.voices.popitem(last = False)
+            self.loadedBytes -= size
+
+            print(f"Unloaded voice {name} to stay under the voice memory limit.")